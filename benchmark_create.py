@@ -0,0 +1,63 @@
+# Benchmark for the /create route. It fills a throwaway room registry with an increasing number of rooms
+# and times how long creating one more room takes, the latency should stay flat as the registry grows.
+# Creates are timed back to back and again right after a chat message, which writes to the same registry
+# file, so a name cache that is dropped on unrelated writes shows up in the second column.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import statistics
+
+# Point the program at a temporary content folder before it is loaded
+workdir = tempfile.mkdtemp(prefix="bitbybit-bench-")
+os.environ["BITBYBIT_CONTENT"] = os.path.join(workdir, "content")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+SIZES = [10, 100, 1000, 10000, 100000]
+SAMPLES = 50
+
+
+"""
+    desc- inserts rooms straight into the registry until it holds the requested number of rooms
+
+    param- the number of rooms the registry should hold
+"""
+def fill_registry(size):
+    with main.app.app_context():
+        current = main.Room.query.count()
+        main.db.session.bulk_insert_mappings(main.Room,
+            [{"name": "filler{}".format(i), "passcode": ""} for i in range(current, size)])
+        main.db.session.commit()
+
+
+"""
+    desc- creates a number of new rooms through the /create route and returns the median latency in milliseconds.
+    With chat set a message is posted (untimed) to the current room before every create
+
+    param- the size label used to keep the room names unique, the number of rooms to create and whether to chat in between
+"""
+def time_create(size, samples, chat=False):
+    client = main.app.test_client()
+    client.get('/')
+    timings = []
+    for i in range(samples):
+        if chat:
+            client.post('/chat', data={'chatarea': "bench message {}".format(i)})
+        start = time.perf_counter()
+        client.post('/create', data={'links': "bench{}x{}{}".format(size, i, "c" if chat else ""), 'passcodes': '', 'TTL': '20000'})
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    try:
+        print("{:>10} {:>15} {:>25}".format("rooms", "create (ms)", "create after chat (ms)"))
+        for size in SIZES:
+            fill_registry(size)
+            print("{:>10} {:>15.3f} {:>25.3f}".format(size, time_create(size, SAMPLES), time_create(size, SAMPLES, chat=True)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
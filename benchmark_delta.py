@@ -0,0 +1,145 @@
+# Benchmark for delta storage of tracked files. It uploads a series of versions of one file, each a few small
+# edits away from the previous one, once with whole versions and once with DELTA_VERSIONS on. It reports the
+# disk used by the version folder and how long downloading (rebuilding) the versions takes. It then checks that
+# versions encoded out of order (a newer one before the one it is made against) can all still be downloaded.
+
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import statistics
+
+# Point the program at a temporary content folder before it is loaded
+workdir = tempfile.mkdtemp(prefix="bitbybit-bench-")
+os.environ["BITBYBIT_CONTENT"] = os.path.join(workdir, "content")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+FILE_SIZE = 8 * 1024 * 1024
+VERSIONS = 48
+EDITS = 5
+CHUNK_SIZE = 1024 * 1024
+
+
+"""
+    desc- returns a copy of the data with a few random insertions, deletions and overwrites of up to 512 bytes
+
+    param- the data to edit
+"""
+def edit(data):
+    data = bytearray(data)
+    for i in range(EDITS):
+        pos = random.randrange(len(data))
+        size = random.randint(1, 512)
+        kind = random.random()
+        if kind < 0.33:
+            data[pos:pos] = os.urandom(size)
+        elif kind < 0.66:
+            del data[pos:pos+size]
+        else:
+            data[pos:pos+size] = os.urandom(len(data[pos:pos+size]))
+    return bytes(data)
+
+
+"""
+    desc- uploads one version of a file through the raw chunk API
+
+    param- the test client, the filename and the content
+"""
+def upload(client, filename, data):
+    details = client.post('/upload', json={"filename": filename, "size": len(data), "chunk_size": CHUNK_SIZE}).get_json()
+    for i in range(details["total"]):
+        client.put('/upload/{}/{}'.format(details["upload_id"], i), data=data[i*CHUNK_SIZE:(i+1)*CHUNK_SIZE])
+
+
+"""
+    desc- returns the bytes used by the version files of a folder, hardlinked files are counted once
+
+    param- the version folder path
+"""
+def disk_usage(folder):
+    seen = set()
+    total = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            if stat.st_ino not in seen:
+                seen.add(stat.st_ino)
+                total += stat.st_size
+    return total
+
+
+"""
+    desc- uploads every version of a file, waits for the delta encoder and returns the disk used plus the download
+    latency in milliseconds of every version
+
+    param- the filename used for this run and the list of version contents
+"""
+def run(filename, contents):
+    client = main.app.test_client()
+    client.get('/')
+    for data in contents:
+        upload(client, filename, data)
+    main.deltas.queue.join()
+
+    folder = os.path.join(main.app.config["UPLOADED_PATH"], "placeholder", main.switchFiletoFolder(filename, ".", "-"))
+    client.get('/versions/', query_string={"data-status": folder})
+    timings = []
+    for version, data in enumerate(contents, start=1):
+        start = time.perf_counter()
+        body = client.post('/versions/', data={"versions": "{}.bin".format(version)}).get_data()
+        timings.append((time.perf_counter() - start) * 1000)
+        assert hashlib.sha256(body).digest() == hashlib.sha256(data).digest(), "version {} differs".format(version)
+    return disk_usage(folder), timings
+
+
+"""
+    desc- uploads three versions of a file with delta storage off and encodes them newest first, the way the encoder
+    sees them when versions finish together, then checks every version still downloads intact
+
+    param- none
+"""
+def check_out_of_order():
+    client = main.app.test_client()
+    client.get('/')
+    contents = [os.urandom(1024 * 1024)]
+    for i in range(2):
+        contents.append(edit(contents[-1]))
+    main.app.config["DELTA_VERSIONS"] = False
+    for data in contents:
+        upload(client, "order.bin", data)
+
+    customPath = os.path.join(main.app.config["UPLOADED_PATH"], "placeholder")
+    with main.app.app_context():
+        main.encode_version(customPath, "order-bin", "3.bin")
+        main.encode_version(customPath, "order-bin", "2.bin")
+
+    client.get('/versions/', query_string={"data-status": os.path.join(customPath, "order-bin")})
+    for version, data in enumerate(contents, start=1):
+        body = client.post('/versions/', data={"versions": "{}.bin".format(version)}).get_data()
+        assert hashlib.sha256(body).digest() == hashlib.sha256(data).digest(), "version {} differs".format(version)
+    return sorted(name for name in os.listdir(os.path.join(customPath, "order-bin")) if name != "VersionInfo")
+
+
+if __name__ == '__main__':
+    try:
+        random.seed(7)
+        print("{:>8} {:>14} {:>18} {:>18}".format("mode", "disk (MiB)", "download p50 (ms)", "download max (ms)"))
+        for mode, enabled in (("whole", False), ("delta", True)):
+            # Each run gets its own content, the blob store would otherwise share the versions of the first run
+            contents = [os.urandom(FILE_SIZE)]
+            for i in range(VERSIONS - 1):
+                contents.append(edit(contents[-1]))
+
+            main.app.config["DELTA_VERSIONS"] = enabled
+            used, timings = run(mode + ".bin", contents)
+            print("{:>8} {:>14.2f} {:>18.2f} {:>18.2f}".format(mode, used / 1024 / 1024,
+                statistics.median(timings), max(timings)))
+        print("out of order encoding: {} intact".format(", ".join(check_out_of_order())))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,156 @@
+# Benchmark for chunked uploads through the raw chunk API the options page uses (POST /upload, then
+# PUT /upload/<upload_id>/<chunk_index>). For every concurrency level a fresh server is started, that many
+# files are uploaded at the same time in CHUNK_SIZE chunks (the CHUNK_SIZE of uploader.js) and the peak
+# resident memory of the server is reported per concurrent upload. Every response is checked, a run with a
+# failed request is reported as an error instead of a memory figure. Peak memory is read from
+# /proc/<pid>/status so the numbers are only available on Linux.
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import json
+import http.client
+
+CONCURRENCY = [1, 2, 4, 8]
+CHUNK_SIZE = 10000000
+CHUNKS_PER_FILE = 4
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+payload = os.urandom(1024 * 1024)
+
+
+"""
+    desc- returns a TCP port nobody is listening on
+
+    param- none
+"""
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+"""
+    desc- reads a memory figure in kB (VmRSS or VmHWM) of a process, None when /proc is not available
+
+    param- the process id and the field name
+"""
+def memory_kb(pid, field):
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+"""
+    desc- produces the body of one chunk piece by piece so the benchmark itself never holds a whole chunk in memory
+
+    param- none
+"""
+def chunk_body():
+    remaining = CHUNK_SIZE
+    while remaining:
+        piece = payload[:min(remaining, len(payload))]
+        remaining -= len(piece)
+        yield piece
+
+
+"""
+    desc- sends one request and returns the response body, raises when the server does not answer 200
+
+    param- the server port, the method, the path, the body and the request headers
+"""
+def request(port, method, path, body, headers):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError("{} {} answered {}: {}".format(method, path, response.status, data[:200]))
+        return data
+    finally:
+        conn.close()
+
+
+"""
+    desc- uploads one file chunk by chunk, a failure is added to the errors list
+
+    param- the server port, the session cookie, the file number and the list collecting errors
+"""
+def upload_file(port, cookie, number, errors):
+    try:
+        details = json.loads(request(port, "POST", "/upload", json.dumps({"filename": "bench{}.bin".format(number),
+            "size": CHUNK_SIZE * CHUNKS_PER_FILE, "chunk_size": CHUNK_SIZE, "note": "benchmark"}),
+            {"Cookie": cookie, "Content-Type": "application/json"}))
+        for index in range(CHUNKS_PER_FILE):
+            request(port, "PUT", "/upload/{}/{}".format(details["upload_id"], index), chunk_body(),
+                {"Cookie": cookie, "Content-Length": str(CHUNK_SIZE), "Content-Type": "application/octet-stream"})
+    except (OSError, ValueError, RuntimeError) as e:
+        errors.append(e)
+
+
+"""
+    desc- starts a server, runs a number of uploads at the same time and returns the extra peak memory
+    in kB and the time taken
+
+    param- the number of concurrent uploads
+"""
+def run(concurrency):
+    workdir = tempfile.mkdtemp(prefix="bitbybit-bench-")
+    port = free_port()
+    env = dict(os.environ, BITBYBIT_CONTENT=os.path.join(workdir, "content"))
+    server = subprocess.Popen([sys.executable, "-c",
+        "import main; from werkzeug.serving import run_simple; run_simple('127.0.0.1', {}, main.app, threaded=True)".format(port)],
+        cwd=basedir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for attempt in range(100):
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                conn.request("GET", "/")
+                response = conn.getresponse()
+                response.read()
+                cookie = response.getheader("Set-Cookie").split(";")[0]
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        baseline = memory_kb(server.pid, "VmRSS")
+        start = time.perf_counter()
+        errors = []
+        threads = [threading.Thread(target=upload_file, args=(port, cookie, i, errors)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise RuntimeError("{} of {} uploads failed, first error: {}".format(len(errors), concurrency, errors[0]))
+
+        peak = memory_kb(server.pid, "VmHWM")
+        if baseline is None or peak is None:
+            return None, elapsed
+        return peak - baseline, elapsed
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    print("{:>12} {:>18} {:>22} {:>10}".format("concurrent", "peak extra (MB)", "per upload (MB)", "time (s)"))
+    for concurrency in CONCURRENCY:
+        extra, elapsed = run(concurrency)
+        if extra is None:
+            print("{:>12} {:>18} {:>22} {:>10.2f}".format(concurrency, "n/a", "n/a", elapsed))
+        else:
+            print("{:>12} {:>18.1f} {:>22.1f} {:>10.2f}".format(concurrency, extra / 1024,
+                extra / 1024 / concurrency, elapsed))
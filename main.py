@@ -4,13 +4,25 @@ from flask import *
 import os
 import time
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 import tarfile
 import secrets
 import re
-from threading import Thread
+from threading import Thread, Lock, Condition, local
+from collections import deque
+import queue
+import heapq
+import struct
+import atexit
 import shutil
+import hashlib
+import base64
+import zlib
+import mmap
 from werkzeug.utils import secure_filename
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+import click
 
 
 # Global variables required for later use in the project.
@@ -26,332 +38,2550 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 # Creating flask environment variables as relative paths
 app = Flask(__name__)
 app.config.update(
-    UPLOADED_PATH= os.path.join(basedir,'content')
+    UPLOADED_PATH= os.environ.get("BITBYBIT_CONTENT", os.path.join(basedir,'content'))
 )
 
 # Global variables to be utilised later
 # PATH strings as a shortcut to important folders
-PATH_chats = app.config["UPLOADED_PATH"] + r"\chatrooms.txt"
-PATH_tempfiles = app.config["UPLOADED_PATH"] + r"\tempZipFiles"
+PATH_chats = os.path.join(app.config["UPLOADED_PATH"], "chatrooms.txt")
+PATH_tempfiles = os.path.join(app.config["UPLOADED_PATH"], "tempZipFiles")
+PATH_registry = os.path.join(app.config["UPLOADED_PATH"], "rooms.db")
+PATH_reaping = os.path.join(app.config["UPLOADED_PATH"], ".reaping")
+PATH_uploads = os.path.join(app.config["UPLOADED_PATH"], ".uploads")
+PATH_blobs = os.path.join(app.config["UPLOADED_PATH"], ".blobs")
+
+# Uploads nobody has sent a chunk for in UPLOAD_TTL seconds are dropped together with their partial file,
+# the check runs at most once every UPLOAD_SWEEP seconds
+UPLOAD_TTL = 24 * 3600
+UPLOAD_SWEEP = 600
+
+# Every room keeps its chat messages and upload events in one append-only log of JSON lines plus an index
+# holding the byte offset of every record as an 8 byte integer, so record n starts at the offset stored at n*8
+# in the index. The position of a record in the log is its sequence number, which /updater uses as a cursor
+MESSAGE_LOG = ".messages.log"
+MESSAGE_INDEX = ".messages.idx"
+MESSAGE_MIGRATED = os.path.join(app.config["UPLOADED_PATH"], ".messages-migrated")
+VERSIONS_MIGRATED = os.path.join(app.config["UPLOADED_PATH"], ".versions-migrated")
+
+# Number of most recent messages shown when a chat page is rendered
+MESSAGE_PAGE = 200
+
+# Number of versions shown when the versions page opens and sent per page by the versions API, a page holds
+# at most VERSIONS_PAGE_MAX versions
+VERSIONS_PAGE = 50
+VERSIONS_PAGE_MAX = 500
+
+# Every room keeps a small manifest describing its files (type, name shown in the chat, latest version, size
+# and modification time). It is updated whenever an upload or a new version is written so the chat page
+# and /updater can list a room from one read instead of walking its folders
+MANIFEST = ".manifest.json"
+
+# Every tracked file keeps a HEAD pointer in VersionInfo/HEAD, a small JSON file holding its latest version number,
+# extension, version filename, original filename, size and SHA-256. It is replaced atomically when a newer version finishes so the latest
+# version of a file is read from one file instead of listing its version folder
+VERSION_HEAD = "HEAD"
+
+# A version of a tracked file stored as a delta is kept as <n>.<ext>.delta next to the whole versions
+DELTA = ".delta"
+
+# Every tracked file keeps the last version number it handed out in VersionInfo/counter. New versions are
+# allocated by bumping the counter under the lock of that file, so two uploads never get the same number
+VERSION_COUNTER = "counter"
+
+# Seconds between heartbeats sent to idle /events streams so proxies keep the connection open
+EVENTS_HEARTBEAT = 15
+
+# I/O budget of the room reaper. Deleting files is limited to REAPER_BYTES_PER_SECOND, every file costs at
+# least REAPER_MIN_COST bytes and large files are truncated REAPER_CHUNK bytes at a time before being removed
+app.config.update(
+    REAPER_BYTES_PER_SECOND= 64 * 1024 * 1024,
+    REAPER_MIN_COST= 4096,
+    REAPER_CHUNK= 16 * 1024 * 1024
+)
+
+# Opt-in delta storage for tracked files. With DELTA_VERSIONS on, a new version is stored as a binary delta against
+# the latest whole version (snapshot) before it, so rebuilding any version reads one snapshot and one delta. A version
+# is kept whole when DELTA_SNAPSHOT_EVERY versions have passed since that snapshot, when it is larger than
+# DELTA_MAX_SIZE bytes or when its delta would not shrink it below DELTA_MAX_RATIO of its size.
+# Deltas are made of DELTA_BLOCK byte blocks copied from the snapshot plus the new bytes in between
+app.config.update(
+    DELTA_VERSIONS= False,
+    DELTA_SNAPSHOT_EVERY= 16,
+    DELTA_BLOCK= 4096,
+    DELTA_MAX_SIZE= 256 * 1024 * 1024,
+    DELTA_MAX_RATIO= 0.5
+)
+
+# Retention of old versions of tracked files. The newest version is always kept, RETENTION_KEEP_LAST keeps the
+# newest N versions, RETENTION_KEEP_DAILY keeps the newest version of each of the last N days and RETENTION_MAX_BYTES
+# drops the oldest kept versions once the versions of a file add up to more bytes. None switches a rule off and with
+# every rule off nothing is removed. A room with its own Retention row uses that policy instead of this one.
+# The collector checks every tracked file every RETENTION_INTERVAL seconds, RETENTION_BATCH files at a time,
+# and a file as soon as a new version of it finishes
+app.config.update(
+    RETENTION_KEEP_LAST= None,
+    RETENTION_KEEP_DAILY= None,
+    RETENTION_MAX_BYTES= None,
+    RETENTION_INTERVAL= 3600,
+    RETENTION_BATCH= 100
+)
+
+# Upload chunks are copied to disk through a reusable buffer of UPLOAD_BUFFER_SIZE bytes per thread instead
+# of being read into memory whole. MAX_FORM_MEMORY_SIZE caps the memory used by the non-file form fields
+app.config.update(
+    UPLOAD_BUFFER_SIZE= 1024 * 1024,
+    MAX_FORM_MEMORY_SIZE= 1024 * 1024
+)
+
+
+"""
+    desc- the request class of the program, it takes the form memory cap from the app config
+"""
+class BoundedRequest(Request):
+    @property
+    def max_form_memory_size(self):
+        return current_app.config["MAX_FORM_MEMORY_SIZE"]
+
+
+app.request_class = BoundedRequest
+
+# The room registry is an SQLite database kept next to the room folders
+app.config.update(
+    SQLALCHEMY_DATABASE_URI= "sqlite:///" + PATH_registry,
+    SQLALCHEMY_TRACK_MODIFICATIONS= False
+)
+db = SQLAlchemy(app)
+
+# Error messages to be flashed for the create and join variables 
+ERR_pass = "Wrong passcode provided!"
+ERR_room = "No room by that name present!"
+ERR_word = "Room names are only one word long!"
+ERR_same = "Room with that name already exists!"
+ERR_expired = "room expired"
+
+# Session creating temporary variables
+secret = secrets.token_urlsafe(32)
+app.secret_key = secret
+
+
+"""
+    desc- a row of the room registry. Rooms are looked up by their unique (indexed) name so joining
+    or creating a room no longer has to walk a text file. expires_at is empty for rooms that live indefinitely
+"""
+class Room(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), unique=True, index=True, nullable=False)
+    passcode = db.Column(db.String(120), nullable=False, default="")
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+    bytes_used = db.Column(db.Integer, nullable=False, default=0)
+
+
+"""
+    desc- a named counter of the registry. The "rooms" counter is bumped in the same transaction as every room that
+    is added or removed, so the in-memory name set can tell when it is stale without looking at the registry file
+"""
+class Generation(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+"""
+    desc- a file of the content-addressed blob store, kept at .blobs/<first 2 hex digits>/<other 62 hex digits>
+    of its SHA-256. refs counts the files in the rooms that are hardlinks of it, a blob nothing refers to is deleted
+"""
+class Blob(db.Model):
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+
+
+"""
+    desc- a version of a tracked file. Versions are looked up by room, version folder and number, path is the file
+    the version is stored in inside its version folder (<n>.<ext> or <n>.<ext>.delta)
+"""
+class Version(db.Model):
+    __table_args__ = (db.UniqueConstraint("room", "folder", "number"),)
+    id = db.Column(db.Integer, primary_key=True)
+    room = db.Column(db.String(120), nullable=False)
+    folder = db.Column(db.String(255), nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+    note = db.Column(db.Text, nullable=False, default="")
+    size = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)
+    uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    path = db.Column(db.String(255), nullable=False)
+
+
+"""
+    desc- the retention policy of a room, it replaces the global RETENTION_* policy for the tracked files of the room.
+    An empty column switches that rule off
+"""
+class Retention(db.Model):
+    room = db.Column(db.String(120), primary_key=True)
+    keep_last = db.Column(db.Integer, nullable=True)
+    keep_daily = db.Column(db.Integer, nullable=True)
+    max_bytes = db.Column(db.BigInteger, nullable=True)
+
+
+"""
+    desc- a file in a room that is a hardlink of a blob, by its path relative to the content folder
+"""
+class BlobRef(db.Model):
+    path = db.Column(db.String(512), primary_key=True)
+    sha256 = db.Column(db.String(64), db.ForeignKey("blob.sha256"), nullable=False, index=True)
+
+
+"""
+    desc- a one-shot migration that copies every "name : passcode" line of the old chatrooms.txt file into
+    the room registry. The text file is renamed afterwards so the import never runs twice
+
+    param- the path of the chatrooms.txt file to import
+"""
+def import_chatrooms(path):
+    imported = 0
+    if not os.path.exists(path):
+        return imported
+
+    with open(path, encoding = 'utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            parts = line.split(" : ")
+            name = parts[0].strip()
+            passcode = parts[1].strip() if len(parts) > 1 else ""
+
+            if Room.query.filter_by(name=name).first() is None:
+                db.session.add(Room(name=name, passcode=passcode))
+                imported += 1
+    if imported:
+        bump_rooms_generation()
+    db.session.commit()
+
+    os.replace(path, path + ".imported")
+    return imported
+
+
+"""
+    desc- creates the content folders, the registry tables and the placeholder room if they are missing
+    and imports a leftover chatrooms.txt file from an older install
+
+    param- none
+"""
+def setup_storage():
+    os.makedirs(os.path.join(app.config["UPLOADED_PATH"], "placeholder"), exist_ok=True)
+    os.makedirs(PATH_tempfiles, exist_ok=True)
+    os.makedirs(PATH_blobs, exist_ok=True)
+
+    with app.app_context():
+        db.create_all()
+        if db.session.get(Generation, "rooms") is None:
+            db.session.add(Generation(name="rooms", value=0))
+            db.session.commit()
+        import_chatrooms(PATH_chats)
+        if Room.query.filter_by(name="placeholder").first() is None:
+            db.session.add(Room(name="placeholder", passcode="123"))
+            bump_rooms_generation()
+            db.session.commit()
+
+    # One-shot move of the old per-message tEXt files into the message logs
+    if not os.path.exists(MESSAGE_MIGRATED):
+        migrate_all_messages()
+        open(MESSAGE_MIGRATED, "w").close()
+
+    # One-shot copy of the old VersionInfo.txt notes into the version table
+    if not os.path.exists(VERSIONS_MIGRATED):
+        with app.app_context():
+            migrate_all_versions()
+        open(VERSIONS_MIGRATED, "w").close()
+
+
+# Guards the blob store so a blob is never collected while an upload is being linked to it
+blobs_lock = Lock()
+
+
+"""
+    desc- returns the path of a blob in the blob store
+
+    param- the SHA-256 of the blob as hex
+"""
+def blob_path(sha256):
+    return os.path.join(PATH_blobs, sha256[:2], sha256[2:])
+
+
+"""
+    desc- adds a finished file to the blob store. A file whose content is already stored is replaced by a hardlink
+    of the blob, so identical uploads in any room or version folder share one copy on disk, otherwise the file itself
+    becomes the blob. Returns the number of bytes saved. Without hardlink support the file is simply kept as it is
+
+    param- the path of the file and its SHA-256 as hex
+"""
+def store_blob(path, sha256):
+    relative = os.path.relpath(path, app.config["UPLOADED_PATH"])
+    stored = blob_path(sha256)
+    size = os.path.getsize(path)
+    saved = 0
+    with blobs_lock:
+        blob = Blob.query.get(sha256)
+        try:
+            if blob is not None and os.path.exists(stored) and os.path.samefile(stored, path):
+                pass
+            elif blob is not None and os.path.exists(stored):
+                temp = path + "." + secrets.token_hex(4)
+                os.link(stored, temp)
+                os.replace(temp, path)
+                saved = size
+            else:
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                if os.path.exists(stored):
+                    os.remove(stored)
+                os.link(path, stored)
+        except OSError as e:
+            print("File could not be linked into the blob store", path, e)
+            return 0
+
+        if blob is None:
+            blob = Blob(sha256=sha256, size=size, refs=0)
+            db.session.add(blob)
+        blob.refs += 1
+        db.session.merge(BlobRef(path=relative, sha256=sha256))
+        db.session.commit()
+    return saved
+
+
+"""
+    desc- drops the blob references of the files under a path and deletes the blobs nothing refers to anymore without
+    committing, so the caller can commit it with its own changes. Returns the number of references dropped and the
+    SHA-256 of the blobs deleted. Must be called holding blobs_lock
+
+    param- a path relative to the content folder, a folder when it ends with os.sep
+"""
+def drop_blob_refs(path):
+    if path.endswith(os.sep):
+        refs = BlobRef.query.filter(BlobRef.path.startswith(path, autoescape=True)).all()
+    else:
+        refs = BlobRef.query.filter_by(path=path).all()
+    counts = {}
+    for ref in refs:
+        counts[ref.sha256] = counts.get(ref.sha256, 0) + 1
+        db.session.delete(ref)
+    for sha256, count in counts.items():
+        Blob.query.filter_by(sha256=sha256).update({Blob.refs: Blob.refs - count})
+
+    deleted = set()
+    for blob in Blob.query.filter(Blob.sha256.in_(list(counts)), Blob.refs <= 0).all():
+        try:
+            os.remove(blob_path(blob.sha256))
+        except OSError:
+            pass
+        db.session.delete(blob)
+        deleted.add(blob.sha256)
+    return len(refs), deleted
+
+
+"""
+    desc- drops the blob references of the files under a path and deletes the blobs nothing refers to anymore.
+    Files in the rooms are hardlinks, so the content of a deleted blob stays on disk until its last room file is gone
+
+    param- a path relative to the content folder, a folder when it ends with os.sep
+"""
+def release_blobs(path):
+    with blobs_lock:
+        count, deleted = drop_blob_refs(path)
+        db.session.commit()
+    return count
+
+
+"""
+    desc- adds a number of bytes (negative to take them off) to the usage counter of a room without committing, so
+    it is saved with the change it accounts for. The counter holds logical bytes: the text of the messages plus the
+    size of every version and file kept in the room, however the blob store and delta storage keep them on disk
+
+    param- the room name and the number of bytes
+"""
+def change_room_usage(roomname, nbytes):
+    Room.query.filter_by(name=roomname).update({Room.bytes_used: Room.bytes_used + nbytes})
+
+
+"""
+    desc- adds a number of bytes to the usage counter of a room in the registry
+
+    param- the room name and the number of bytes written into it
+"""
+def add_room_usage(roomname, nbytes):
+    change_room_usage(roomname, nbytes)
+    db.session.commit()
+
+
+# In-memory set of all room names for constant time duplicate checks. It is loaded once from the
+# registry and reloaded only when the "rooms" generation shows a room was added or removed by another
+# process. Messages, uploads and versions write to the same registry file but leave the generation alone
+room_names = set()
+room_names_generation = None
+room_names_lock = Lock()
+
+
+"""
+    desc- bumps the "rooms" generation inside the current transaction, called by everything that adds or removes
+    rooms before it commits
+
+    param- none
+"""
+def bump_rooms_generation():
+    Generation.query.filter_by(name="rooms").update({Generation.value: Generation.value + 1})
+
+
+"""
+    desc- returns the current "rooms" generation of the registry, a single primary key lookup
+
+    param- none
+"""
+def rooms_generation():
+    return db.session.query(Generation.value).filter_by(name="rooms").scalar()
+
+
+"""
+    desc- checks whether a room name is already taken using the in-memory name set, the set is (re)loaded
+    from the registry the first time and whenever the "rooms" generation has moved
+
+    param- the room name to look for
+"""
+def room_exists(name):
+    global room_names, room_names_generation
+    with room_names_lock:
+        generation = rooms_generation()
+        if room_names_generation is None or generation != room_names_generation:
+            room_names = set(name for (name,) in db.session.query(Room.name))
+            room_names_generation = generation
+        return name in room_names
+
+
+"""
+    desc- adds or removes a room name from the in-memory name set after the registry has been written by this program
+
+    param- the room name and whether it was added (True) or removed (False)
+"""
+def remember_room(name, present=True):
+    global room_names_generation
+    with room_names_lock:
+        if present:
+            room_names.add(name)
+        else:
+            room_names.discard(name)
+        room_names_generation = rooms_generation()
+
+
+"""
+    desc- a function that replaces the '.' character in a filename to a '-' to serve as a folder name and vice versa
+    param- the original filename, the old delimiter either '.' or '-', the replacement delimiter either '.' or '-'
+"""
+def switchFiletoFolder(filename, olddelim, newdelim):
+    if olddelim in filename:
+        real_type = filename.split(olddelim)[0] + newdelim + filename.split(olddelim)[1]
+    else:
+        real_type = filename
+    return real_type
+
+
+"""
+    desc- a function that returns the version number attached to a file when tracking changes by splitting the 
+    filename on the delimiter '.' and getting the text on the left side of the delimiter (the filename not the extension)
+
+    param- the base filename without the additional PATH attached to it.
+"""
+def getVersion(filename):
+    return os.path.splitext(filename)[0]
+
+
+"""
+    desc- a function that returns a list of filenames and foldernames present in a directory. the result is a list of file
+    and folder names
+
+    param- the path of the directory to loop through.
+"""
+def lister(dir_path):
+    result = []
+    for file in os.listdir(dir_path):
+        result.append(os.fsdecode(file))
+    
+    return result
+
+
+"""
+    desc- a function that returns a list of filenames and excludes folder names. the result is a list of
+    filenames
+
+    param- the path of the directory to loop through.
+"""
+def lister2(dir_path):
+    result = []
+    for file in os.listdir(dir_path):
+        if os.path.isdir(os.path.join(dir_path, os.fsdecode(file))):
+            continue
+        result.append(os.fsdecode(file))
+    
+    return result
+
+
+"""
+    desc- a function that returns all filenames within a directory, reserved for use in a version control folder
+    to return the filename as an Integer. The whole leading number is used so versions above 999 sort correctly
+
+    param- the filename from a list
+"""
+def extract_file_number(f):
+    s = re.match("\d+",f)
+    return (int(s.group(0)) if s else -1,f)
+
+# Largest number of rooms expired (and written to the registry) in one go, this bounds the work done
+# when a backlog of overdue rooms is found after a restart
+EXPIRY_BATCH = 100
+
+# Seconds before a room whose folder could not be moved away (a file in it is held open, which blocks the
+# rename on Windows) is tried again
+EXPIRY_RETRY = 60
+
+
+# Version token of every room, bumped on every write and sent as an ETag so unchanged pages and polls are
+# answered with 304 Not Modified. The boot id makes tokens from an earlier run of the program stale
+BOOT_ID = secrets.token_hex(4)
+room_versions = {}
+room_versions_lock = Lock()
+
+
+"""
+    desc- marks a room as changed so its ETag no longer matches copies held by browsers
+
+    param- the room name
+"""
+def bump_room_version(roomname):
+    with room_versions_lock:
+        room_versions[roomname] = room_versions.get(roomname, 0) + 1
+
+
+"""
+    desc- returns the current ETag value of a room
+
+    param- the room name
+"""
+def room_etag(roomname):
+    with room_versions_lock:
+        return "{}-{}-{}".format(roomname, BOOT_ID, room_versions.get(roomname, 0))
+
+
+"""
+    desc- an empty 304 Not Modified response carrying the ETag the browser already has
+
+    param- the ETag value
+"""
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# Locks that serialise writes to the files of a single room, rooms never wait on each other
+room_locks = {}
+room_locks_lock = Lock()
+
+
+"""
+    desc- returns the lock guarding the files of a room, creating it the first time
+
+    param- the room name
+"""
+def room_lock(roomname):
+    with room_locks_lock:
+        if roomname not in room_locks:
+            room_locks[roomname] = Lock()
+        return room_locks[roomname]
+
+
+# Locks that serialise version allocation and VersionInfo writes of a single tracked file, other files
+# and rooms never wait on each other
+file_locks = {}
+file_locks_lock = Lock()
+
+
+"""
+    desc- returns the lock guarding the version metadata of a tracked file, creating it the first time
+
+    param- the room folder path and the version folder name
+"""
+def file_lock(customPath, folder_name):
+    key = os.path.join(customPath, folder_name)
+    with file_locks_lock:
+        if key not in file_locks:
+            file_locks[key] = Lock()
+        return file_locks[key]
+
+
+"""
+    desc- an in-process publish/subscribe hub. Every open /events stream subscribes to its room with a queue
+    and every record written to a room log is published to the queues of that room, rooms nobody is
+    watching cost nothing
+
+    param- none
+"""
+class EventHub:
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = Lock()
+
+    # Returns a new queue that receives the records published to a room
+    def subscribe(self, roomname):
+        q = queue.Queue()
+        with self.lock:
+            self.subscribers.setdefault(roomname, set()).add(q)
+        return q
+
+    def unsubscribe(self, roomname, q):
+        with self.lock:
+            queues = self.subscribers.get(roomname)
+            if queues is not None:
+                queues.discard(q)
+                if not queues:
+                    del self.subscribers[roomname]
+
+    # Hands a record to everyone watching a room
+    def publish(self, roomname, record):
+        with self.lock:
+            queues = list(self.subscribers.get(roomname, ()))
+        for q in queues:
+            q.put(record)
+
+    # Number of open streams
+    def listeners(self):
+        with self.lock:
+            return sum(len(queues) for queues in self.subscribers.values())
+
+
+hub = EventHub()
+
+
+"""
+    desc- appends a record to the log of a room and records its offset in the index. The record gets the next
+    sequence number of the room (its position in the log starting at 1), which is returned. The record is
+    also published to the /events streams of the room, this is how chat() and options() notify open pages
+
+    param- the room folder path, the room name, the record dict and optionally the time of the event
+"""
+def append_entry(customPath, roomname, record, sent=None):
+    sent = sent or datetime.utcnow()
+    with room_lock(roomname):
+        seq = message_count(customPath) + 1
+        line = json.dumps(dict(record, seq=seq, time=sent.isoformat())) + "\n"
+        with open(os.path.join(customPath, MESSAGE_LOG), "ab") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(line.encode('utf-8'))
+        with open(os.path.join(customPath, MESSAGE_INDEX), "ab") as f:
+            f.write(struct.pack(">Q", offset))
+
+        # Published while holding the lock so streams see the records in sequence order
+        bump_room_version(roomname)
+        hub.publish(roomname, dict(record, seq=seq, time=sent.isoformat()))
+    return seq
+
+
+"""
+    desc- appends a chat message to the log of a room and returns its sequence number
+
+    param- the room folder path, the room name, the message text and optionally the time it was sent
+"""
+def append_message(customPath, roomname, text, sent=None):
+    return append_entry(customPath, roomname, {"type": "message", "text": text}, sent)
+
+
+"""
+    desc- appends a finished upload to the log of a room so open chat pages pick it up, returns its sequence number
+
+    param- the room folder path, the room name, the original filename, the name shown in the chat
+    and the path the chat links to
+"""
+def append_upload(customPath, roomname, filename, display, path):
+    return append_entry(customPath, roomname, {"type": "file", "file": filename, "name": display, "path": path})
+
+
+"""
+    desc- turns a log record into the key and value pair used by the chat page, messages use the
+    "tEXt" prefix followed by their sequence number
+
+    param- the log record
+"""
+def entry_item(record):
+    if record.get("type", "message") == "message":
+        return ("tEXt"+str(record["seq"]), record["text"].replace('\n', ' '))
+    return (record["name"], record["path"])
+
+
+"""
+    desc- turns a log record into the entry sent to open chat pages by /updater and /events
+
+    param- the log record
+"""
+def entry_payload(record):
+    key, value = entry_item(record)
+    return {"seq": record["seq"], "type": record.get("type", "message"), "key": key, "value": value,
+        "file": record.get("file")}
+
+
+"""
+    desc- returns the number of records in the log of a room from the size of its index, this is also
+    the sequence number of the newest record
+
+    param- the room folder path
+"""
+def message_count(customPath):
+    try:
+        return os.path.getsize(os.path.join(customPath, MESSAGE_INDEX)) // 8
+    except OSError:
+        return 0
+
+
+"""
+    desc- reads the records of a room with a sequence number above a cursor. Only the needed part of the
+    index is read, followed by a single seek into the log. The result is a list of log records
+
+    param- the room folder path, the cursor (0 for the start of the log) and the maximum number of records,
+    when limit is given only the newest records after the cursor are returned
+"""
+def read_messages(customPath, after=0, limit=None):
+    count = message_count(customPath)
+    start = after
+    if limit is not None:
+        start = max(after, count - limit)
+    if start >= count:
+        return []
+
+    with open(os.path.join(customPath, MESSAGE_INDEX), "rb") as f:
+        f.seek(start * 8)
+        offset = struct.unpack(">Q", f.read(8))[0]
+    with open(os.path.join(customPath, MESSAGE_LOG), "rb") as f:
+        f.seek(offset)
+        lines = f.read().splitlines()
+
+    # Records written after the index was measured are left for the next read
+    return [json.loads(line) for line in lines[:count - start]]
+
+
+"""
+    desc- moves the old one-file-per-message tEXt files of a room into its message log, oldest first.
+    The time a message was sent is taken from the tEXt%Y%m%d-%H%M%S filename
+
+    param- the room folder path and the room name
+"""
+def migrate_messages(customPath, roomname):
+    migrated = 0
+    for filename in sorted(lister2(customPath)):
+        if not filename.startswith("tEXt"):
+            continue
+        try:
+            sent = datetime.strptime(os.path.splitext(filename)[0], "tEXt%Y%m%d-%H%M%S")
+        except ValueError:
+            sent = None
+        with open(os.path.join(customPath, filename), "r", encoding = 'utf-8') as f:
+            append_message(customPath, roomname, f.read(), sent)
+        os.remove(os.path.join(customPath, filename))
+        migrated += 1
+    return migrated
+
+
+"""
+    desc- runs migrate_messages over every room folder
+
+    param- none
+"""
+def migrate_all_messages():
+    migrated = 0
+    for roomname in lister(app.config["UPLOADED_PATH"]):
+        customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+        if roomname.startswith(".") or roomname == "tempZipFiles" or not os.path.isdir(customPath):
+            continue
+        migrated += migrate_messages(customPath, roomname)
+    return migrated
+
+
+"""
+    desc- copies the versions of the tracked files of a room into the version table. Notes come from the
+    "Version N: note" lines of VersionInfo/VersionInfo.txt, the number is read up to the colon so "Version 1"
+    never picks up the note of "Version 10". Versions without a note line never finished and are skipped
+
+    param- the room folder path and the room name
+"""
+def migrate_versions(customPath, roomname):
+    migrated = 0
+    for folder_name in lister(customPath):
+        folder = os.path.join(customPath, folder_name)
+        if folder_name.startswith(".") or not os.path.isfile(os.path.join(folder, "VersionInfo", "VersionInfo.txt")):
+            continue
+
+        notes = {}
+        with open(os.path.join(folder, "VersionInfo", "VersionInfo.txt"), encoding = 'utf-8', errors = 'replace') as f:
+            for line in f:
+                number, sep, note = line.partition(": ")
+                if sep and number.startswith("Version ") and number[len("Version "):].isdigit():
+                    notes[int(number[len("Version "):])] = note.rstrip("\n")
+        digests = {}
+        try:
+            with open(os.path.join(folder, "VersionInfo", "digests.txt"), encoding = 'utf-8') as f:
+                for line in f:
+                    number, sep, digest = line.partition(": ")
+                    if sep and number[len("Version "):].isdigit():
+                        digests[int(number[len("Version "):])] = digest.strip()
+        except OSError:
+            pass
+
+        existing = set(number for (number,) in db.session.query(Version.number).filter_by(room=roomname, folder=folder_name))
+        for filename in lister2(folder):
+            number = filename.split(".")[0]
+            if not number.isdigit() or int(number) not in notes or int(number) in existing:
+                continue
+            stat = os.stat(os.path.join(folder, filename))
+            size = delta_header(os.path.join(folder, filename))["size"] if filename.endswith(DELTA) else stat.st_size
+            db.session.add(Version(room=roomname, folder=folder_name, number=int(number), note=notes[int(number)],
+                size=size, sha256=digests.get(int(number)), uploaded_at=datetime.utcfromtimestamp(stat.st_mtime),
+                path=filename))
+            existing.add(int(number))
+            migrated += 1
+    db.session.commit()
+    return migrated
+
+
+"""
+    desc- runs migrate_versions over every room folder
+
+    param- none
+"""
+def migrate_all_versions():
+    migrated = 0
+    for roomname in lister(app.config["UPLOADED_PATH"]):
+        customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+        if roomname.startswith(".") or roomname == "tempZipFiles" or not os.path.isdir(customPath):
+            continue
+        migrated += migrate_versions(customPath, roomname)
+    return migrated
+
+
+"""
+    desc- writes the manifest of a room atomically, it is written to a temporary file which then replaces the old one
+
+    param- the room folder path and the manifest dict
+"""
+def write_manifest(customPath, manifest):
+    temp = os.path.join(customPath, MANIFEST + "." + secrets.token_hex(4))
+    with open(temp, "w", encoding = 'utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(temp, os.path.join(customPath, MANIFEST))
+
+
+"""
+    desc- regenerates the manifest of a room from its folder tree, the latest version of a tracked file is the
+    file with the highest version number in its folder
+
+    param- the room folder path
+"""
+def build_manifest(customPath):
+    manifest = {"entries": {}}
+    for filename in sorted(lister(customPath)):
+        path = os.path.join(customPath, filename)
+        if filename.startswith("."):
+            continue
+
+        elif os.path.isdir(path):
+            head = read_head(path)
+            if head is not None:
+                manifest["entries"][filename] = head_entry(filename, head)
+                continue
+
+            # Folders written before HEAD pointers existed are listed
+            versionFiles = lister2(path)
+            if not versionFiles:
+                continue
+            latest_file = max(versionFiles, key=extract_file_number)
+            stat = os.stat(os.path.join(path, latest_file))
+            size = stat.st_size
+            if latest_file.endswith(DELTA):
+                size = delta_header(os.path.join(path, latest_file))["size"]
+                latest_file = latest_file[:-len(DELTA)]
+            manifest["entries"][filename] = {"type": "tracked", "name": switchFiletoFolder(filename, "-", "."),
+                "latest": getVersion(latest_file), "file": latest_file, "size": size, "mtime": stat.st_mtime}
+
+        else:
+            stat = os.stat(path)
+            manifest["entries"][filename] = {"type": "file", "name": filename,
+                "size": stat.st_size, "mtime": stat.st_mtime}
+    return manifest
+
+
+"""
+    desc- returns the manifest of a room, rooms from before manifests existed get one built on first use
+
+    param- the room folder path and the room name
+"""
+def read_manifest(customPath, roomname):
+    try:
+        with open(os.path.join(customPath, MANIFEST), encoding = 'utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        with room_lock(roomname):
+            manifest = build_manifest(customPath)
+            write_manifest(customPath, manifest)
+        return manifest
+
+
+"""
+    desc- records a new or changed file in the manifest of a room
+
+    param- the room folder path, the room name, the file or version folder name and its manifest entry
+"""
+def update_manifest(customPath, roomname, filename, entry):
+    read_manifest(customPath, roomname)
+    with room_lock(roomname):
+        with open(os.path.join(customPath, MANIFEST), encoding = 'utf-8') as f:
+            manifest = json.load(f)
+        # Versions of a file can finish out of order, an older version never replaces a newer one as the latest
+        current = manifest["entries"].get(filename)
+        if current and current["type"] == "tracked" and entry["type"] == "tracked" and int(current["latest"]) > int(entry["latest"]):
+            return
+        manifest["entries"][filename] = entry
+        write_manifest(customPath, manifest)
+
+
+"""
+    desc- returns the HEAD pointer of a tracked file, None for a folder written before HEAD pointers existed
+
+    param- the version folder path
+"""
+def read_head(folder):
+    try:
+        with open(os.path.join(folder, "VersionInfo", VERSION_HEAD), encoding = 'utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+"""
+    desc- points the HEAD of a tracked file at a finished version unless a newer version already finished.
+    Must be called holding the lock of the file
+
+    param- the room folder path, the version folder name and the head dict (version, ext, file, name, size, sha256, mtime)
+"""
+def write_head(customPath, folder_name, head):
+    folder = os.path.join(customPath, folder_name)
+    current = read_head(folder)
+    if current is not None and current["version"] > head["version"]:
+        return
+    path = os.path.join(folder, "VersionInfo", VERSION_HEAD)
+    temp = path + "." + secrets.token_hex(4)
+    with open(temp, "w", encoding = 'utf-8') as f:
+        json.dump(head, f)
+    os.replace(temp, path)
+
+
+"""
+    desc- builds the manifest entry of a tracked file from its HEAD pointer
+
+    param- the version folder name and the HEAD pointer
+"""
+def head_entry(folder_name, head):
+    return {"type": "tracked", "name": head.get("name") or switchFiletoFolder(folder_name, "-", "."), "latest": str(head["version"]),
+        "file": head["file"], "size": head["size"], "mtime": head["mtime"], "sha256": head.get("sha256")}
+
+
+"""
+    desc- records a finished upload of a version tracked file in the manifest of its room, the entry is taken
+    from the HEAD pointer of the file
+
+    param- the room folder path, the room name and the version folder name
+"""
+def manifest_version(customPath, roomname, folder_name):
+    head = read_head(os.path.join(customPath, folder_name))
+    if head is not None:
+        update_manifest(customPath, roomname, folder_name, head_entry(folder_name, head))
+
+
+"""
+    desc- builds the key and value pairs shown on the chat page: the latest messages from the message log followed
+    by the files from the manifest. Messages use the "tEXt" prefix, tracked files show their latest version
+
+    param- the room folder path and the room name
+"""
+def room_listing(customPath, roomname):
+    chat_content = {}
+    for record in read_messages(customPath, limit=MESSAGE_PAGE):
+        if record.get("type", "message") == "message":
+            key, value = entry_item(record)
+            chat_content[key] = value
+
+    for filename, entry in read_manifest(customPath, roomname)["entries"].items():
+        if entry["type"] == "tracked":
+            chat_content[entry["name"]+": Version "+str(entry["latest"])] = os.path.join(customPath, filename)
+        else:
+            chat_content[entry["name"]] = os.path.join(customPath, filename)
+    return chat_content
+
+
+"""
+    desc- regenerates the manifest of every room, or of a single room, from the folder tree
+
+    param- the room name or None for every room
+"""
+def rebuild_manifests(roomname=None):
+    rebuilt = 0
+    for name in ([roomname] if roomname else lister(app.config["UPLOADED_PATH"])):
+        customPath = os.path.join(app.config["UPLOADED_PATH"], name)
+        if name.startswith(".") or name == "tempZipFiles" or not os.path.isdir(customPath):
+            continue
+        with room_lock(name):
+            write_manifest(customPath, build_manifest(customPath))
+        bump_room_version(name)
+        rebuilt += 1
+    return rebuilt
+
+
+"""
+    desc- a single background thread that expires rooms. Deadlines are kept in a min-heap so the thread only
+    wakes up when the earliest room is due. Cancelled or extended rooms leave their old heap entry behind,
+    it is skipped when it reaches the top because it no longer matches the room's current deadline.
+    Changed deadlines are remembered until they are flushed to the registry by the thread or at shutdown
+
+    param- the function called with a batch of room names whose deadline has passed and the function
+    called with a {room name: deadline or None} dict of deadlines that still have to be saved
+"""
+class ExpiryScheduler:
+    def __init__(self, on_expire, on_persist):
+        self.on_expire = on_expire
+        self.on_persist = on_persist
+        self.heap = []
+        self.deadlines = {}
+        self.dirty = {}
+        self.condition = Condition()
+        self.thread = None
+        self.stopping = False
+
+    # Starts the scheduler thread, calling it more than once has no effect
+    def start(self):
+        if self.thread is None:
+            self.stopping = False
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # Stops the scheduler thread and saves every deadline that has not been flushed yet
+    def stop(self, timeout=10):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self.flush()
+
+    # Loads deadlines that are already saved in the registry, overdue rooms expire on the next batch
+    def load(self, deadlines):
+        with self.condition:
+            for name, deadline in deadlines:
+                self.deadlines[name] = deadline
+                self.heap.append((deadline, name))
+            heapq.heapify(self.heap)
+            self.condition.notify()
+
+    # Adds a room or replaces its deadline (a UTC datetime), persist=False when the caller already saved it
+    def schedule(self, name, deadline, persist=True):
+        with self.condition:
+            self.deadlines[name] = deadline
+            heapq.heappush(self.heap, (deadline, name))
+            if persist:
+                self.dirty[name] = deadline
+            self.condition.notify()
+
+    # Stops a room from expiring, returns False if it was not scheduled
+    def cancel(self, name):
+        with self.condition:
+            if self.deadlines.pop(name, None) is None:
+                return False
+            self.dirty[name] = None
+            self.condition.notify()
+            return True
+
+    # Pushes the deadline of a scheduled room back by a number of seconds and returns the new deadline
+    def extend(self, name, seconds):
+        with self.condition:
+            if name not in self.deadlines:
+                return None
+            deadline = self.deadlines[name] + timedelta(seconds=seconds)
+            self.deadlines[name] = deadline
+            self.dirty[name] = deadline
+            heapq.heappush(self.heap, (deadline, name))
+            self.condition.notify()
+            return deadline
+
+    # Number of rooms waiting to expire
+    def pending(self):
+        with self.condition:
+            return len(self.deadlines)
+
+    # Saves the deadlines changed since the last flush
+    def flush(self):
+        with self.condition:
+            changes, self.dirty = self.dirty, {}
+        if changes:
+            try:
+                self.on_persist(changes)
+            except Exception as e:
+                # Keep the changes so the next flush tries again, newer changes win
+                print("Saving room deadlines failed", e)
+                with self.condition:
+                    changes.update(self.dirty)
+                    self.dirty = changes
+
+    # Returns up to EXPIRY_BATCH room names whose deadline has passed, dropping stale heap entries on the way
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < EXPIRY_BATCH:
+            deadline, name = heapq.heappop(self.heap)
+            if self.deadlines.get(name) == deadline:
+                del self.deadlines[name]
+                self.dirty.pop(name, None)
+                due.append(name)
+        return due
+
+    def run(self):
+        while True:
+            with self.condition:
+                due = self.pop_due(datetime.utcnow())
+                while not due and not self.dirty and not self.stopping:
+                    # Drop cancelled or extended entries before deciding how long to sleep
+                    while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+                        heapq.heappop(self.heap)
+                    if self.heap:
+                        self.condition.wait(max(0, (self.heap[0][0] - datetime.utcnow()).total_seconds()))
+                    else:
+                        self.condition.wait()
+                    due = self.pop_due(datetime.utcnow())
+                if self.stopping:
+                    return
+
+            self.flush()
+            if due:
+                try:
+                    self.on_expire(due)
+                except Exception as e:
+                    print("Room expiry failed", due, e)
+
+
+"""
+    desc- a background thread that deletes the folders of expired rooms. Folders are removed file by file
+    and large files are shrunk in steps so deleting a room holding gigabytes of files never blocks the program
+    or saturates the disk, the thread sleeps whenever it gets ahead of the configured I/O budget
+
+    param- none
+"""
+class Reaper:
+    def __init__(self):
+        self.queue = deque()
+        self.condition = Condition()
+        self.thread = None
+        self.spent = 0
+        self.started = time.monotonic()
+
+    # Starts the reaper thread, calling it more than once has no effect
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # Queues a folder for deletion
+    def enqueue(self, path):
+        with self.condition:
+            self.queue.append(path)
+            self.condition.notify()
+
+    # Number of folders waiting to be deleted
+    def pending(self):
+        with self.condition:
+            return len(self.queue)
+
+    # Records an amount of I/O and sleeps until it fits in the budget
+    def throttle(self, cost):
+        self.spent += max(cost, app.config["REAPER_MIN_COST"])
+        ahead = self.spent / app.config["REAPER_BYTES_PER_SECOND"] - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    # Removes a single file, large files are truncated from the end in REAPER_CHUNK steps first. A file that is
+    # also a blob (or linked from another room) is only unlinked, truncating it would destroy the other copies
+    def remove_file(self, path):
+        stat = os.stat(path)
+        size = stat.st_size
+        if size > app.config["REAPER_CHUNK"] and stat.st_nlink == 1:
+            with open(path, "r+b") as f:
+                while size > app.config["REAPER_CHUNK"]:
+                    size -= app.config["REAPER_CHUNK"]
+                    f.truncate(size)
+                    self.throttle(app.config["REAPER_CHUNK"])
+        os.remove(path)
+        self.throttle(size)
+
+    # Deletes a folder tree bottom up
+    def remove_tree(self, path):
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                self.remove_file(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+                self.throttle(0)
+        os.rmdir(path)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                path = self.queue[0]
+
+            # Start a fresh budget window after being idle
+            if self.spent == 0 or time.monotonic() - self.started > 1:
+                self.spent = 0
+                self.started = time.monotonic()
+            try:
+                self.remove_tree(path)
+            except OSError as e:
+                print("Room folder could not be removed", path, e)
+
+            with self.condition:
+                self.queue.popleft()
+
+
+reaper = Reaper()
+
+
+"""
+    desc- removes a batch of expired rooms. Each room folder is renamed into the .reaping folder first,
+    which is atomic so the room disappears from /chat and /updater straight away, and the reaper deletes it
+    later. The rooms are taken out of the registry in a single transaction for the whole batch. A room whose folder
+    could not be moved stays in the registry and is scheduled again EXPIRY_RETRY seconds later
+
+    param- the list of chatnames/directory names to delete
+"""
+def expire_rooms(chatnames):
+    os.makedirs(PATH_reaping, exist_ok=True)
+    moved = []
+    for chatname in chatnames:
+        source = os.path.join(app.config["UPLOADED_PATH"], chatname)
+        target = os.path.join(PATH_reaping, chatname + "-" + secrets.token_hex(4))
+        try:
+            # Uploads finishing into the room hold its lock while they add their version
+            with room_lock(chatname):
+                os.replace(source, target)
+        except FileNotFoundError:
+            moved.append(chatname)
+            continue
+        except OSError as e:
+            print("Room folder could not be moved", chatname, e)
+            expiry.schedule(chatname, datetime.utcnow() + timedelta(seconds=EXPIRY_RETRY))
+            continue
+        moved.append(chatname)
+        reaper.enqueue(target)
+        bump_room_version(chatname)
+        hub.publish(chatname, {"type": "deleted", "text": '"{}" timer has expired'.format(chatname)})
+
+    # Remove the rooms that are gone from the registry and release the blobs their files referred to
+    if not moved:
+        return
+    with app.app_context():
+        Room.query.filter(Room.name.in_(moved)).delete(synchronize_session=False)
+        Version.query.filter(Version.room.in_(moved)).delete(synchronize_session=False)
+        Retention.query.filter(Retention.room.in_(moved)).delete(synchronize_session=False)
+        bump_rooms_generation()
+        db.session.commit()
+        for chatname in moved:
+            remember_room(chatname, False)
+            release_blobs(chatname + os.sep)
+
+
+"""
+    desc- queues room folders that were still waiting to be deleted when the program last stopped
+
+    param- none
+"""
+def load_reaping():
+    if os.path.isdir(PATH_reaping):
+        for name in os.listdir(PATH_reaping):
+            reaper.enqueue(os.path.join(PATH_reaping, name))
+
+
+"""
+    desc- writes changed room deadlines to the registry in a single transaction
+
+    param- a dict of room name to deadline, None when the room no longer expires
+"""
+def save_deadlines(changes):
+    with app.app_context():
+        for name, deadline in changes.items():
+            Room.query.filter_by(name=name).update({Room.expires_at: deadline})
+        db.session.commit()
+
+
+"""
+    desc- schedules every room that has a deadline saved in the registry, used when the program starts
+
+    param- none
+"""
+def load_deadlines():
+    with app.app_context():
+        expiry.load(db.session.query(Room.name, Room.expires_at).filter(Room.expires_at.isnot(None)).all())
+
+
+expiry = ExpiryScheduler(expire_rooms, save_deadlines)
+
+
+"""
+    desc- The primary URL route. Displays the index page and sets up initial session
+    variable "current_room" as the temporary folder
+
+    param- none
+"""
+@app.route('/')
+def hello():
+    # Create the necessary folders if they do not exist
+    if not os.path.exists( app.config["UPLOADED_PATH"] ):
+        setup_storage()
+    session["current_room"] = "placeholder"
+    return render_template('index.html', template_folder='templates')
+
+
+"""
+    desc- The create route that allows users to create rooms and deternmine their lifetime
+"""
+@app.route('/create',methods=['POST','GET'])
+def create():
+    # Response to POST request scenario
+    if request.method == 'POST':
+        # Accessing form element values
+        room = request.form.get('links')
+        passcode = request.form.get('passcodes')
+        duration = int(request.form.get('TTL'))
+
+        # Initial search to find related or similar rooms
+        if(re.search(newRoomRegex, room)):
+
+            # Look the room name up in the set of existing rooms
+            # Return error message in the event it does not work
+            if(room_exists(room)):
+                flash(ERR_same)
+                return redirect(url_for('create'))
+            
+            # Create room directory
+            if not (os.path.exists( os.path.join(app.config["UPLOADED_PATH"], room) )):
+                os.mkdir((app.config["UPLOADED_PATH"]+"/"+room))
+            # Add new room to the room registry, rooms with a timer also store their deadline
+            expires_at = None
+            if(not(duration >= 20000)):
+                expires_at = datetime.utcnow() + timedelta(seconds=duration)
+            db.session.add(Room(name=room, passcode=passcode or "", expires_at=expires_at))
+            bump_rooms_generation()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another request created the same room in the meantime
+                db.session.rollback()
+                flash(ERR_same)
+                return redirect(url_for('create'))
+            remember_room(room)
+
+            # Setting the room session variable to the created one
+            session["current_room"] = room
+            
+            # Check the timer value obtained from the form. 
+            if expires_at is not None:
+                expiry.schedule(room, expires_at, persist=False)
+            
+            # forward to user to the created chat page
+            return redirect(url_for('chat'))
+        else:
+
+            # Error scenarios that return to the previous page
+            flash(ERR_word)
+            return redirect(url_for('create'))
+    
+    # default route when redirected to this page instead of a form request  
+    return render_template('create.html', template_folder='templates')
+
+
+"""
+    desc- The select route that allows users to select rooms that are already present
+"""
+@app.route('/select',methods=['POST','GET'])
+def select():
+
+    # Response to form POST request scenario
+    if request.method == 'POST':
+
+        # obtaining values from the FORM posted
+        room = request.form.get('links')
+        passcode = request.form.get('passcodes')
+
+        # Cross checking with the room registry to find the appropriate group
+        entry = Room.query.filter_by(name=room).first()
+
+        # no room scenrio, highlight the error and refresh the page
+        if entry is None:
+            flash(ERR_room)
+            return redirect(url_for('select'))
+
+        # scenrio one, the lack of a pascode attached to the room
+        # in this scenario so long as the room exists it will be loaded in
+        # redirect to the chat page with the correct room as the reference
+        if not entry.passcode.strip():
+            session["current_room"] = room
+            return redirect(url_for('chat'))
+
+        # scenario two, the room has a passcode and the input passcode
+        # from the user is correct
+        # redirect to the chat page with the correct room as the reference
+        if entry.passcode.strip() == passcode:
+            session["current_room"] = room
+            return redirect(url_for('chat'))
+
+        # Incorrect passcode scenario, highlight the error and refresh the page
+        flash(ERR_pass)
+        return redirect(url_for('select'))
+
+    # default route when redirected to this page instead of form request         
+    return render_template('select.html', template_folder='templates')
+ 
+
+"""
+    desc- The chat route common for all users that uses a roomname to dynamically
+    generate the contents in the room when redirected to.
+"""
+@app.route('/chat',methods=['POST','GET'])
+def chat():
+    # Initial PATH and name related fields
+    roomname = session["current_room"]
+    customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+    global current_chat
+    current_chat = session["current_room"]
+
+    # The page the browser holds is still current, skip reading the room
+    etag = room_etag(roomname)
+    if request.method == 'GET' and request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    # Scenario for when users enter and submit a message
+    if request.method == 'POST':
+
+        # Obtaining the message string from within the form
+        text = request.form.get('chatarea')
+
+        print("Message Received", str(text))
+
+        if not text == "":
+
+            # Saving the message at the end of the message log of the room
+            append_message(customPath, roomname, text)
+            add_room_usage(roomname, len(text.encode('utf-8')))
+
+    # Dynamic generation of content using the message log and the manifest of the room
+    cursor = message_count(customPath)
+    chat_content = room_listing(customPath, roomname)
+
+    response = make_response(render_template('chat_template.html', template_folder='templates', var=roomname, dict_item=chat_content, cursor=cursor))
+    if request.method == 'GET':
+        # Browsers have to revalidate the page every time, which costs a 304 while nothing changes
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+# Copy buffers of the request threads, each thread allocates its buffer once and reuses it
+copy_buffers = local()
+
+
+"""
+    desc- copies a stream into an open file through the copy buffer of the current thread, so memory use
+    stays at one buffer per thread whatever the size of the stream. Returns the number of bytes copied
+
+    param- the stream to read from, the file to write to and optionally a hash fed with everything copied
+"""
+def copy_stream(stream, f, sha=None):
+    buffer = getattr(copy_buffers, "buffer", None)
+    if buffer is None or len(buffer) != app.config["UPLOAD_BUFFER_SIZE"]:
+        buffer = copy_buffers.buffer = bytearray(app.config["UPLOAD_BUFFER_SIZE"])
+    view = memoryview(buffer)
+    readinto = getattr(stream, "readinto", None)
+
+    copied = 0
+    while True:
+        if readinto is not None:
+            n = readinto(view)
+        else:
+            data = stream.read(len(buffer))
+            n = len(data)
+            view[:n] = data
+        if not n:
+            return copied
+        f.write(view[:n])
+        if sha is not None:
+            sha.update(view[:n])
+        copied += n
+
+
+"""
+    desc- writes a chunk at its byte offset in the target file. The file is created and preallocated to its
+    full size by whichever chunk arrives first, so chunks can be written in any order. The chunk is streamed
+    to disk through copy_stream and the number of bytes written is returned
+
+    param- the target path, the byte offset of the chunk, the stream holding the chunk, the total size of the file
+    and optionally a hash fed with the chunk
+"""
+def write_chunk(path, offset, stream, total_size, sha=None):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    with os.fdopen(fd, "r+b") as f:
+        if total_size and os.fstat(f.fileno()).st_size < total_size:
+            f.truncate(total_size)
+        f.seek(offset)
+        return copy_stream(stream, f, sha)
+
+
+"""
+    desc- the running SHA-256 of an upload. It covers every chunk before its frontier: the chunk at the frontier
+    is hashed while it is written and chunks that arrived early are read back from the file once the frontier
+    reaches them, so a file never has to be read again in full once it is complete. The state lives in memory
+    only, after a restart the hash starts over from the beginning of the file
+
+    param- none
+"""
+class ChunkHasher:
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.sha = hashlib.sha256()
+        self.frontier = 0
+
+    # Hashes the chunks from the frontier onwards that are already in the file, must be called holding the lock
+    def advance(self, upload):
+        chunk_size = upload["chunk_size"]
+        with open(upload["target"], "rb") as f:
+            while self.frontier < len(upload["bitmap"]) and upload["bitmap"][self.frontier]:
+                f.seek(self.frontier * chunk_size)
+                remaining = min(chunk_size, upload["size"] - self.frontier * chunk_size)
+                while remaining > 0:
+                    data = f.read(min(remaining, app.config["UPLOAD_BUFFER_SIZE"]))
+                    if not data:
+                        break
+                    self.sha.update(data)
+                    remaining -= len(data)
+                self.frontier += 1
+
+
+"""
+    desc- the registry of every upload in progress, keyed by upload id (the dzuuid Dropzone gives a file or the id
+    handed out by POST /upload). Each upload record owns the state of one file: its room and name, the target path
+    and version it was given, a bitmap of the chunks received so far and the number of bytes written. Any number of
+    files and users can upload at once, the registry lock only guards the records and never covers writing a chunk.
+    Records are saved in the .uploads folder as <id>.json plus a <id>.chunks bitmap with one byte per chunk, so an
+    interrupted upload can be resumed after a restart. Uploads nobody has sent a chunk for in UPLOAD_TTL seconds
+    are dropped together with their partial file.
+    Files sent together form a batch with one slot per file, saved as <id>.batch. The files of a batch upload
+    concurrently and the batch is finalised once, by the upload that completes its last slot.
+    Every upload in progress also has a ChunkHasher computing its SHA-256 as the chunks arrive
+
+    param- the folder the records are saved in
+"""
+class UploadRegistry:
+    def __init__(self, folder):
+        self.folder = folder
+        self.uploads = {}
+        self.batches = {}
+        self.hashers = {}
+        self.lock = Lock()
+        self.last_sweep = 0
+
+    # Path of a file belonging to an upload record, ext is ".json" or ".chunks"
+    def path(self, upload_id, ext):
+        return os.path.join(self.folder, secure_filename(upload_id) + ext)
+
+    # Saves the details of a record (everything except the bitmap) atomically, after applying any changes.
+    # Nothing is written when the changes are already in the record
+    def save(self, upload_id, upload, **changes):
+        with self.lock:
+            if changes and all(upload.get(key) == value for key, value in changes.items()):
+                return
+            upload.update(changes)
+            upload["updated"] = time.time()
+            details = dict((key, value) for key, value in upload.items() if key != "bitmap")
+            temp = self.path(upload_id, ".json." + secrets.token_hex(4))
+            with open(temp, "w", encoding = 'utf-8') as f:
+                json.dump(details, f)
+            os.replace(temp, self.path(upload_id, ".json"))
+
+    # Returns the record of an upload from memory or from the .uploads folder, None if there is none
+    def find(self, upload_id):
+        with self.lock:
+            if upload_id in self.uploads:
+                return self.uploads[upload_id]
+            try:
+                with open(self.path(upload_id, ".json"), encoding = 'utf-8') as f:
+                    upload = json.load(f)
+                with open(self.path(upload_id, ".chunks"), "rb") as f:
+                    upload["bitmap"] = bytearray(f.read())
+                upload["received"] = sum(upload["bitmap"])
+            except (OSError, ValueError):
+                return None
+            upload.setdefault("written", 0)
+            self.uploads[upload_id] = upload
+            return upload
+
+    # Returns the record of an upload, creating it when the first chunk of the file arrives
+    def start(self, upload_id, total_chunks):
+        self.expire()
+        upload = self.find(upload_id)
+        if upload is not None:
+            return upload
+
+        with self.lock:
+            if upload_id not in self.uploads:
+                os.makedirs(self.folder, exist_ok=True)
+                with open(self.path(upload_id, ".chunks"), "wb") as f:
+                    f.write(bytes(total_chunks))
+                self.uploads[upload_id] = {"bitmap": bytearray(total_chunks), "received": 0, "written": 0,
+                    "version": None, "target": None, "zipname": None, "complete": False, "updated": time.time()}
+            upload = self.uploads[upload_id]
+        self.save(upload_id, upload)
+        return upload
+
+    # Returns the running hash of an upload, creating it the first time
+    def hasher(self, upload_id):
+        with self.lock:
+            if upload_id not in self.hashers:
+                self.hashers[upload_id] = ChunkHasher()
+            return self.hashers[upload_id]
+
+    def drop_hasher(self, upload_id):
+        with self.lock:
+            self.hashers.pop(upload_id, None)
+
+    # Forgets an upload and deletes its record, the partial file of an unfinished upload is deleted with it
+    def drop(self, upload_id, upload):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+            self.hashers.pop(upload_id, None)
+        if not upload.get("complete") and upload.get("target"):
+            try:
+                os.remove(upload["target"])
+            except OSError:
+                pass
+        for ext in (".json", ".chunks"):
+            try:
+                os.remove(self.path(upload_id, ext))
+            except OSError:
+                pass
+
+    # Checks whether a chunk of an upload has been saved already
+    def has_chunk(self, upload, index):
+        return upload["complete"] or bool(upload["bitmap"][index])
+
+    # Marks every chunk of an upload as received at once, for an upload whose file was made without any chunks
+    def fill(self, upload_id):
+        with self.lock:
+            upload = self.uploads[upload_id]
+            upload["bitmap"] = bytearray(b"\x01" * len(upload["bitmap"]))
+            upload["received"] = len(upload["bitmap"])
+            with open(self.path(upload_id, ".chunks"), "wb") as f:
+                f.write(upload["bitmap"])
+        self.save(upload_id, upload, complete=True)
+
+    # Indexes of the chunks of an upload saved so far
+    def chunks(self, upload):
+        with self.lock:
+            return [i for i, done in enumerate(upload["bitmap"]) if done]
+
+    # Marks a chunk of an upload as received in memory and in its bitmap file and adds the bytes written.
+    # Returns True exactly once, for the chunk that completes the file
+    def mark(self, upload_id, index, written):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None or upload["complete"] or upload["bitmap"][index]:
+                return False
+            upload["bitmap"][index] = 1
+            upload["received"] += 1
+            upload["written"] += written
+            upload["updated"] = time.time()
+            with open(self.path(upload_id, ".chunks"), "r+b") as f:
+                f.seek(index)
+                f.write(b"\x01")
+            if upload["received"] < len(upload["bitmap"]):
+                return False
+
+        self.save(upload_id, upload, complete=True)
+        return True
+
+    # Saves a batch atomically, must be called holding the registry lock
+    def write_batch(self, batch_id, batch):
+        batch["updated"] = time.time()
+        temp = self.path(batch_id, ".batch." + secrets.token_hex(4))
+        with open(temp, "w", encoding = 'utf-8') as f:
+            json.dump(batch, f)
+        os.replace(temp, self.path(batch_id, ".batch"))
+
+    # Returns a batch from memory or from the .uploads folder, None if there is none
+    def find_batch(self, batch_id):
+        with self.lock:
+            if batch_id in self.batches:
+                return self.batches[batch_id]
+            try:
+                with open(self.path(batch_id, ".batch"), encoding = 'utf-8') as f:
+                    batch = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self.batches[batch_id] = batch
+            return batch
+
+    # Returns a batch, creating it with a number of empty slots. A finished batch or one of another size is
+    # replaced by a new one
+    def start_batch(self, batch_id, room, zipname, slots):
+        batch = self.find_batch(batch_id)
+        with self.lock:
+            if batch is None or batch["finished"] or len(batch["slots"]) != slots:
+                os.makedirs(self.folder, exist_ok=True)
+                batch = self.batches[batch_id] = {"room": room, "zipname": zipname, "slots": [None] * slots,
+                    "done": [False] * slots, "finished": False}
+                self.write_batch(batch_id, batch)
+            return batch
+
+    # Gives an upload the first free slot of a batch, an upload already in the batch keeps its slot.
+    # Returns False when the batch is full
+    def join_batch(self, batch_id, upload_id, upload):
+        with self.lock:
+            batch = self.batches[batch_id]
+            if upload_id not in batch["slots"]:
+                if None not in batch["slots"]:
+                    return False
+                batch["slots"][batch["slots"].index(None)] = upload_id
+                self.write_batch(batch_id, batch)
+            slot = batch["slots"].index(upload_id)
+        self.save(upload_id, upload, batch=batch_id, slot=slot)
+        return True
+
+    # Marks the slot of a finished upload as done. Returns True exactly once, for the slot that completes the batch
+    def complete_slot(self, batch_id, slot):
+        batch = self.find_batch(batch_id)
+        with self.lock:
+            if batch is None or batch["finished"] or batch["done"][slot]:
+                return False
+            batch["done"][slot] = True
+            batch["finished"] = all(batch["done"])
+            self.write_batch(batch_id, batch)
+            return batch["finished"]
+
+    # Progress of every file of a batch and of the batch as a whole, None for an unknown batch
+    def batch_status(self, batch_id):
+        batch = self.find_batch(batch_id)
+        if batch is None:
+            return None
+        files = []
+        for slot, upload_id in enumerate(batch["slots"]):
+            upload = self.find(upload_id) if upload_id else None
+            if upload is None:
+                files.append({"slot": slot, "upload_id": None, "complete": False})
+                continue
+            files.append({"slot": slot, "upload_id": upload_id, "filename": upload.get("filename"),
+                "total": len(upload["bitmap"]), "received": self.chunks(upload), "written": upload["written"],
+                "complete": upload["complete"], "sha256": upload.get("sha256"), "error": upload.get("error")})
+        return {"batch_id": batch_id, "zipname": batch["zipname"], "slots": len(batch["slots"]),
+            "done": sum(batch["done"]), "complete": batch["finished"], "files": files}
+
+    # Number of uploads still waiting for chunks
+    def active(self):
+        with self.lock:
+            return sum(1 for upload in self.uploads.values() if not upload["complete"])
+
+    # Drops records that have not changed for UPLOAD_TTL seconds, the partial file of an unfinished upload is
+    # deleted with it. Runs at most once every UPLOAD_SWEEP seconds unless forced
+    def expire(self, force=False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_sweep < UPLOAD_SWEEP:
+                return
+            self.last_sweep = now
+        if not os.path.isdir(self.folder):
+            return
+
+        for filename in lister(self.folder):
+            if filename.endswith(".batch"):
+                self.expire_batch(filename[:-len(".batch")], now)
+                continue
+            if not filename.endswith(".json"):
+                continue
+            upload_id = filename[:-len(".json")]
+            try:
+                with open(self.path(upload_id, ".json"), encoding = 'utf-8') as f:
+                    upload = json.load(f)
+            except (OSError, ValueError):
+                continue
+            with self.lock:
+                if now - self.uploads.get(upload_id, upload).get("updated", 0) < UPLOAD_TTL:
+                    continue
+            self.drop(upload_id, upload)
+
+    # Drops a batch that has not changed for UPLOAD_TTL seconds, the staging folder of an unfinished batch goes with it
+    def expire_batch(self, batch_id, now):
+        batch = self.find_batch(batch_id)
+        with self.lock:
+            if batch is None or now - batch.get("updated", 0) < UPLOAD_TTL:
+                return
+            self.batches.pop(batch_id, None)
+        if not batch["finished"]:
+            shutil.rmtree(os.path.join(PATH_tempfiles, batch_id), ignore_errors=True)
+        try:
+            os.remove(self.path(batch_id, ".batch"))
+        except OSError:
+            pass
+
+
+uploads = UploadRegistry(PATH_uploads)
+
+
+"""
+    desc- hands out the next version number of a tracked file by bumping its VersionInfo/counter, the folders
+    required for version control are created for a new file. Must be called holding the lock of the file
+
+    param- the room folder path and the version folder name
+"""
+def allocate_version(customPath, folder_name):
+    infoPath = os.path.join(customPath, folder_name, "VersionInfo")
+    counterPath = os.path.join(infoPath, VERSION_COUNTER)
+    os.makedirs(infoPath, exist_ok=True)
+    try:
+        with open(counterPath, encoding = 'utf-8') as f:
+            last = int(f.read())
+    except (OSError, ValueError):
+        # Folders written before the counter existed carry on from their highest version on disk
+        # The if/else exists for in the event with no extension is added to the program
+        last = max([int(x.split(".")[0]) if "." in x else int(x)
+            for x in lister2(os.path.join(customPath, folder_name))], default=0)
+
+    temp = counterPath + "." + secrets.token_hex(4)
+    with open(temp, "w", encoding = 'utf-8') as f:
+        f.write(str(last+1))
+    os.replace(temp, counterPath)
+    return last+1
+
+
+"""
+    desc- returns the file an upload is written to, picking it the first time. Files that will be compressed
+    go to the staging folder of their batch, tracked files are staged as <upload id>.part until they are finished
+    and get their version number, so an upload that is abandoned or rejected never takes a version
+
+    param- the upload id and the upload record
+"""
+def upload_target(upload_id, upload):
+    if upload["target"] is None:
+        if upload["zipname"]:
+            staging = os.path.join(PATH_tempfiles, upload["batch"])
+            os.makedirs(staging, exist_ok=True)
+            target = os.path.join(staging, upload["filename"])
+        else:
+            target = os.path.join(PATH_tempfiles, upload_id + ".part")
+        uploads.save(upload_id, upload, target=target)
+    return upload["target"]
+
+
+"""
+    desc- writes a chunk of an upload at its offset and marks it as received. The chunk at the frontier of the
+    running hash of the upload is hashed while it is written, the chunk completing the file waits for the whole
+    hash. A file whose SHA-256 differs from the one given by the client is deleted and the upload gets an error,
+    otherwise it is finished. Returns the number of bytes written, a chunk of the wrong size is not marked
+
+    param- the upload id, the upload record, the index of the chunk and the stream holding it
+"""
+def receive_chunk(upload_id, upload, index, stream):
+    offset = index * upload["chunk_size"]
+    expected = min(upload["chunk_size"], upload["size"] - offset)
+    target = upload_target(upload_id, upload)
+    hasher = uploads.hasher(upload_id)
+
+    inline = hasher.lock.acquire(blocking=False)
+    if inline and hasher.frontier != index:
+        hasher.lock.release()
+        inline = False
+    written = None
+    try:
+        written = write_chunk(target, offset, stream, upload["size"], hasher.sha if inline else None)
+    finally:
+        if inline:
+            # A failed or short chunk has fed the hash bytes that do not belong to the file, start it over
+            if written == expected:
+                hasher.frontier += 1
+            else:
+                hasher.reset()
+            hasher.lock.release()
+    if written != expected:
+        return written
+
+    completed = uploads.mark(upload_id, index, written)
+    if hasher.lock.acquire(blocking=completed):
+        try:
+            hasher.advance(upload)
+        finally:
+            hasher.lock.release()
+    if not completed:
+        return written
+
+    digest = hasher.sha.hexdigest()
+    uploads.drop_hasher(upload_id)
+    if upload.get("expected_sha256") and upload["expected_sha256"] != digest:
+        uploads.save(upload_id, upload, sha256=digest, error="checksum mismatch")
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+        return written
+
+    uploads.save(upload_id, upload, sha256=digest)
+    finish_upload(upload_id, upload)
+    return written
+
+
+"""
+    desc- gives up an upload whose room expired before it finished, the upload gets the ERR_expired error and its
+    record and staged file are deleted, even when all of its chunks had arrived
+
+    param- the upload id and the upload record
+"""
+def drop_expired_upload(upload_id, upload):
+    uploads.save(upload_id, upload, error=ERR_expired)
+    uploads.drop(upload_id, upload)
+    if upload.get("target"):
+        try:
+            os.remove(upload["target"])
+        except OSError:
+            pass
 
-# Error messages to be flashed for the create and join variables 
-ERR_pass = "Wrong passcode provided!"
-ERR_room = "No room by that name present!"
-ERR_word = "Room names are only one word long!"
-ERR_same = "Room with that name already exists!"
 
-# Session creating temporary variables
-secret = secrets.token_urlsafe(32)
-app.secret_key = secret
+"""
+    desc- finishes an upload once all of its chunks are on disk. A tracked file is moved from its staging file into
+    its version folder under the next version number and gets its version note, manifest entry and chat entry. An
+    upload that is part of a batch completes its slot and the upload completing the last slot finalises the batch.
+    An upload whose room expired meanwhile is dropped instead, nothing is written into the room
+
+    param- the upload id and the upload record
+"""
+def finish_upload(upload_id, upload):
+    roomname = upload["room"]
+    customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+    if not os.path.isdir(customPath):
+        drop_expired_upload(upload_id, upload)
+        return
+
+    # Storing files as Version control objects, files for a zip file wait in the staging folder of their batch
+    if not upload["zipname"]:
+        folder_name = switchFiletoFolder(upload["filename"], ".", "-")
+        # The room lock keeps the room folder from being moved away while the version is added to it
+        with file_lock(customPath, folder_name), room_lock(roomname):
+            if not os.path.isdir(customPath):
+                drop_expired_upload(upload_id, upload)
+                return
+
+            # Uploads started before tracked files were staged already hold their version number
+            if upload["version"] is None:
+                version = str(allocate_version(customPath, folder_name))
+                target = os.path.join( customPath, folder_name, (version+"."+
+                    (upload["filename"].split(".")[1] if "." in upload["filename"] else "")) )
+                os.replace(upload["target"], target)
+                uploads.save(upload_id, upload, version=version, target=target)
+            versionFile = os.path.basename(upload["target"])
+            db.session.add(Version(room=roomname, folder=folder_name, number=int(upload["version"]),
+                note=upload["note"] or "", size=upload["size"], sha256=upload["sha256"], path=versionFile))
+            change_room_usage(roomname, upload["size"])
+            db.session.commit()
+            write_head(customPath, folder_name, {"version": int(upload["version"]), "ext": versionFile.partition(".")[2],
+                "file": versionFile, "name": upload["filename"], "size": upload["size"], "sha256": upload["sha256"],
+                "mtime": time.time()})
+        retention.touch(roomname, folder_name)
+
+        # Identical content already stored anywhere is shared instead of kept twice
+        store_blob(upload["target"], upload["sha256"])
+        manifest_version(customPath, roomname, folder_name)
+        append_upload(customPath, roomname, upload["filename"],
+            upload["filename"]+": Version "+upload["version"], os.path.join(customPath, folder_name))
+        if app.config["DELTA_VERSIONS"]:
+            deltas.enqueue(customPath, folder_name, os.path.basename(upload["target"]))
+
+    if upload.get("batch") and uploads.complete_slot(upload["batch"], upload["slot"]):
+        finish_batch(upload["batch"])
 
 
 """
-    desc- a function that replaces the '.' character in a filename to a '-' to serve as a folder name and vice versa
-    param- the original filename, the old delimiter either '.' or '-', the replacement delimiter either '.' or '-'
+    desc- finalises a batch once every file in it has arrived. The files of a batch for a zip file are packed
+    into a tarfile in the room and their staging folder is removed
+
+    param- the batch id
 """
-def switchFiletoFolder(filename, olddelim, newdelim):
-    if olddelim in filename:
-        real_type = filename.split(olddelim)[0] + newdelim + filename.split(olddelim)[1]
-    else:
-        real_type = filename
-    return real_type
+def finish_batch(batch_id):
+    batch = uploads.find_batch(batch_id)
+    if not batch["zipname"]:
+        return
+
+    roomname = batch["room"]
+    customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+    relativePath = "content/tempZipFiles"
+    staging = os.path.join(PATH_tempfiles, batch_id)
+    tarname = batch["zipname"]+".tar.gz"
+    try:
+        replaced = os.path.getsize(os.path.join(customPath, tarname))
+    except OSError:
+        replaced = 0
+    with tarfile.open(os.path.join(customPath, tarname), "w:gz") as tar_handle:
+        tar_handle.add(staging, arcname=os.path.join(relativePath, batch["zipname"]))
+
+    # Remove these temporary files after being added to the tarfile
+    shutil.rmtree(staging)
+
+    stat = os.stat(os.path.join(customPath, tarname))
+    add_room_usage(roomname, stat.st_size - replaced)
+    update_manifest(customPath, roomname, tarname, {"type": "file", "name": tarname,
+        "size": stat.st_size, "mtime": stat.st_mtime})
+    append_upload(customPath, roomname, tarname, tarname, os.path.join(customPath, tarname))
 
 
 """
-    desc- a function that returns the version comment from the VersionInfo txt file using a 'version number'
-    i.e "Version 1", "Version 2" etc. This is done by looping through line of the file until the right version appears.
+    desc- encodes a file as operations rebuilding it from a base file: ["copy", offset, length] takes bytes from the
+    base and ["data", start, end] inserts the new bytes data[start:end]. Both files can be memory maps, only single
+    blocks are copied out of them while encoding. Blocks of the new file are looked up by hash among the aligned blocks
+    of the base. After a mismatch the encoder resynchronises by searching the next block of the new file for the
+    start of the base blocks it expects next, so an insertion or deletion only costs the bytes around it and the
+    scanning itself runs in C
+
+    param- the base bytes, the new bytes and the block size
+"""
+def make_delta(base, data, block):
+    index = {}
+    for offset in range(0, len(base) - block + 1, block):
+        index.setdefault(hashlib.blake2b(base[offset:offset+block], digest_size=16).digest(), offset)
+
+    ops = []
+    literal = 0
+    expect = 0
+    p = 0
+    while p + block <= len(data):
+        offset = index.get(hashlib.blake2b(data[p:p+block], digest_size=16).digest())
+        if offset is not None:
+            if literal < p:
+                ops.append(["data", literal, p])
+            if ops and ops[-1][0] == "copy" and ops[-1][1] + ops[-1][2] == offset:
+                ops[-1][2] += block
+            else:
+                ops.append(["copy", offset, block])
+            p += block
+            literal = p
+            expect = offset + block
+            continue
+
+        # Jump to the first place within the next block where one of the base blocks expected next starts
+        following = p + block
+        for candidate in range(expect, min(expect + 8 * block, len(base) - block + 1), block):
+            found = data.find(base[candidate:candidate+32], p + 1, following + 32)
+            if found != -1 and found < following:
+                following = found
+        p = following
+
+    if literal < len(data):
+        ops.append(["data", literal, len(data)])
+    return ops
+
 
-    param- the version number and the path where that file is located
 """
-def lineExtractor(version, versionFile):
-    result = ""
-    with open(versionFile, "r") as f:
-        for line in f:
-            if (version in line):
-                result = line
-    return result
+    desc- writes delta operations to a file: a JSON header line followed by the zlib compressed operations, a copy
+    is "C" + offset (8 bytes) + length (4 bytes) and new bytes are "D" + length (4 bytes) + the bytes. New bytes are
+    copied out of the new file UPLOAD_BUFFER_SIZE bytes at a time
 
+    param- the path of the delta file, the header dict, the operations and the new file (bytes or a memory map)
 """
-    desc- a function that returns the version number attached to a file when tracking changes by splitting the 
-    filename on the delimiter '.' and getting the text on the left side of the delimiter (the filename not the extension)
+def write_delta(path, header, ops, data):
+    compressor = zlib.compressobj(6)
+    buffer_size = app.config["UPLOAD_BUFFER_SIZE"]
+    with open(path, "wb") as f:
+        f.write((json.dumps(header) + "\n").encode('utf-8'))
+        for op in ops:
+            if op[0] == "copy":
+                f.write(compressor.compress(b"C" + struct.pack(">QI", op[1], op[2])))
+            else:
+                f.write(compressor.compress(b"D" + struct.pack(">I", op[2] - op[1])))
+                for start in range(op[1], op[2], buffer_size):
+                    f.write(compressor.compress(data[start:min(start + buffer_size, op[2])]))
+        f.write(compressor.flush())
+
 
-    param- the base filename without the additional PATH attached to it.
 """
-def getVersion(filename):
-    return os.path.splitext(filename)[0]
+    desc- returns a function reading the decompressed operations of an open delta file (positioned after its header)
+    a given number of bytes at a time. The body is decompressed incrementally, at most UPLOAD_BUFFER_SIZE compressed
+    bytes are read and UPLOAD_BUFFER_SIZE bytes decompressed per step
+
+    param- the open delta file
+"""
+def delta_reader(f):
+    decompressor = zlib.decompressobj()
+    buffer = bytearray()
+    buffer_size = app.config["UPLOAD_BUFFER_SIZE"]
+
+    def read(n):
+        while len(buffer) < n:
+            chunk = decompressor.unconsumed_tail or f.read(buffer_size)
+            if not chunk:
+                break
+            buffer.extend(decompressor.decompress(chunk, buffer_size))
+        data = bytes(buffer[:n])
+        del buffer[:n]
+        return data
+    return read
 
 
 """
-    desc- a function that returns a list of filenames and foldernames present in a directory. the result is a list of file
-    and folder names
+    desc- opens a file as a read-only memory map so it can be sliced and searched without reading it into memory,
+    an empty file (which cannot be mapped) is returned as empty bytes
 
-    param- the path of the directory to loop through.
+    param- the open file
 """
-def lister(dir_path):
-    result = []
-    for file in os.listdir(dir_path):
-        result.append(os.fsdecode(file))
-    
-    return result
+def map_file(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 """
-    desc- a function that returns a list of filenames and excludes folder names. the result is a list of
-    filenames
+    desc- returns the header of a delta file (base snapshot, its SHA-256 and the size of the version) without
+    reading the operations
 
-    param- the path of the directory to loop through.
+    param- the path of the delta file
 """
-def lister2(dir_path):
-    result = []
-    for file in os.listdir(dir_path):
-        if os.path.isdir(os.path.join(dir_path, os.fsdecode(file))):
-            continue
-        result.append(os.fsdecode(file))
-    
-    return result
+def delta_header(path):
+    with open(path, "rb") as f:
+        return json.loads(f.readline().decode('utf-8'))
 
 
 """
-    desc- a function that returns all filenames within a directory, reserved for use in a version control folder
-    to return the filename as an Integer
+    desc- rebuilds a version stored as a delta piece by piece from its snapshot. The delta body is decompressed
+    as it is read, so a download holds about UPLOAD_BUFFER_SIZE bytes of the snapshot and of the delta at a time
 
-    param- the filename from a list
+    param- the version folder path and the path of the delta file
 """
-def extract_file_number(f):
-    s = re.findall("\d{1,3}",f)
-    return (int(s[0]) if s else -1,f)
+def delta_chunks(folder_name, path):
+    buffer_size = app.config["UPLOAD_BUFFER_SIZE"]
+    with open(path, "rb") as f:
+        header = json.loads(f.readline().decode('utf-8'))
+        read = delta_reader(f)
+        with open(os.path.join(folder_name, header["base"]), "rb") as base:
+            while True:
+                kind = read(1)
+                if not kind:
+                    break
+                if kind == b"C":
+                    offset, length = struct.unpack(">QI", read(12))
+                    source = base
+                    base.seek(offset)
+                else:
+                    (length,) = struct.unpack(">I", read(4))
+                    source = None
+                while length > 0:
+                    data = source.read(min(length, buffer_size)) if source else read(min(length, buffer_size))
+                    if not data:
+                        raise OSError("delta {} or its snapshot {} is truncated".format(os.path.basename(path), header["base"]))
+                    length -= len(data)
+                    yield data
+
 
 """
-    desc- a chat deletion timer, runs on a separate thread and countsdown to 0, at the end of the timer
-    the directory associated to the chat is removed erasing all content in the chat. 
+    desc- tells whether a newer version of a tracked file is stored as a delta against the given version, which must
+    then stay whole. Versions can be encoded out of order when several of them finish at the same time. Must be called
+    holding the lock of the file
 
-    param- the countdown value from the dropdown box value and the chatname/directory name to delete later
+    param- the room name, the version folder path, the version folder name, the version number and its filename
 """
-def timer(t, chatname):
-    time.sleep(3)
-    print(current_chat, chatname)
-    with app.app_context(), app.test_request_context():
-        while t:
-            time.sleep(1)
-            t -= 1
-            print(t)
-    
-        if current_chat == chatname:
-            print("same")
-            os.rmdir(app.config["UPLOADED_PATH"] + "/" + chatname)
-        else:
-            print("not same")
-            os.rmdir(app.config["UPLOADED_PATH"] + "/" + chatname)
-    
-    with open(PATH_chats, "r") as f:
-        lines = f.readlines()
-    with open(PATH_chats, "w") as f:
-        for line in lines:
-            print(line)
-            if chatname not in line.strip("\n"):
-                f.write(line)
+def snapshot_in_use(roomname, folder, folder_name, version, versionFile):
+    for newer in Version.query.filter(Version.room == roomname, Version.folder == folder_name,
+            Version.number > version, Version.path.endswith(DELTA)):
+        try:
+            if delta_header(os.path.join(folder, newer.path))["base"] == versionFile:
+                return True
+        except (OSError, ValueError):
+            # A delta that cannot be read might still need this version
+            return True
+    return False
 
 
 """
-    desc- The primary URL route. Displays the index page and sets up initial session
-    variable "current_room" as the temporary folder
+    desc- stores a finished version of a tracked file as a delta against the latest snapshot before it when that
+    saves enough space, the whole file is removed afterwards. A version sharing its content with other files through
+    the blob store already costs nothing and stays whole. The files are memory mapped and encoded without holding
+    the file lock, which is only taken to pick the snapshot and to swap the delta in after checking that neither
+    file changed meanwhile. A version a newer delta was made against is never encoded
 
-    param- none
+    param- the room folder path, the version folder name and the version filename
 """
-@app.route('/')
-def hello():
-    # Create the necessary folders if they do not exist
-    if not os.path.exists( app.config["UPLOADED_PATH"] ):
-        os.mkdir(app.config["UPLOADED_PATH"])
-        os.mkdir( os.path.join(app.config["UPLOADED_PATH"], "placeholder") )
-        os.mkdir( os.path.join(app.config["UPLOADED_PATH"], "tempZipFiles") )
-        with open( PATH_chats , 'w') as f:
-            f.write("placeholder : 123\n")
-    session["current_room"] = "placeholder"
-    session["currentVersion"] = 1
-    return render_template('index.html', template_folder='templates')
+def encode_version(customPath, folder_name, versionFile):
+    roomname = os.path.basename(customPath)
+    folder = os.path.join(customPath, folder_name)
+    path = os.path.join(folder, versionFile)
+    version = int(versionFile.split(".")[0])
+
+    with file_lock(customPath, folder_name):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        if stat.st_nlink > 2 or stat.st_size == 0 or stat.st_size > app.config["DELTA_MAX_SIZE"]:
+            return
+        if snapshot_in_use(roomname, folder, folder_name, version, versionFile):
+            db.session.commit()
+            return
+
+        # Snapshots are the finished versions kept whole
+        base = Version.query.filter(Version.room == roomname, Version.folder == folder_name,
+            Version.number < version, ~Version.path.endswith(DELTA)).order_by(Version.number.desc()).first()
+        if base is None or version - base.number >= app.config["DELTA_SNAPSHOT_EVERY"]:
+            return
+        base_number, base_path, base_sha256 = base.number, base.path, base.sha256
+        db.session.commit()
+
+    temp = path + DELTA + "." + secrets.token_hex(4)
+    try:
+        with open(os.path.join(folder, base_path), "rb") as f, open(path, "rb") as g:
+            base_data, data = map_file(f), map_file(g)
+            try:
+                ops = make_delta(base_data, data, app.config["DELTA_BLOCK"])
+                write_delta(temp, {"base": base_path, "base_sha256": base_sha256, "size": len(data)}, ops, data)
+            finally:
+                for mapped in (base_data, data):
+                    if isinstance(mapped, mmap.mmap):
+                        mapped.close()
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return
+    if os.path.getsize(temp) > stat.st_size * app.config["DELTA_MAX_RATIO"]:
+        os.remove(temp)
+        return
+
+    with file_lock(customPath, folder_name):
+        # The version and its snapshot must still be the files that were encoded, retention or another upload
+        # linked to the same blob may have changed them while the lock was released
+        current = Version.query.filter_by(room=roomname, folder=folder_name, number=version).first()
+        snapshot = Version.query.filter_by(room=roomname, folder=folder_name, number=base_number).first()
+        try:
+            now = os.stat(path)
+        except OSError:
+            now = None
+        if (current is None or current.path != versionFile or snapshot is None or snapshot.path != base_path
+                or now is None or (now.st_ino, now.st_size, now.st_mtime_ns) != (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                or now.st_nlink > 2 or snapshot_in_use(roomname, folder, folder_name, version, versionFile)):
+            db.session.commit()
+            os.remove(temp)
+            return
+        os.replace(temp, path + DELTA)
+        os.remove(path)
+        current.path = versionFile + DELTA
+
+        # The whole file (and the blob only it referred to) is gone, the usage of the room stays the size of the version
+        with blobs_lock:
+            drop_blob_refs(os.path.relpath(path, app.config["UPLOADED_PATH"]))
+            db.session.commit()
 
 
 """
-    desc- The create route that allows users to create rooms and deternmine their lifetime
+    desc- a background thread storing new versions as deltas, so finishing an upload never waits for the encoding
+
+    param- none
 """
-@app.route('/create',methods=['POST','GET'])
-def create():
-    # Response to POST request scenario
-    if request.method == 'POST':
-        # Accessing form element values
-        room = request.form.get('links')
-        passcode = request.form.get('passcodes')
-        duration = int(request.form.get('TTL'))
-        allRoomNames = []
+class DeltaEncoder:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
 
-        with open(PATH_chats, encoding = 'utf-8') as f:
-            line = f.readline()
-            while line:
-                allRoomNames.append(line.split(":")[0].strip())
-                line = f.readline()
+    # Starts the encoder thread, calling it more than once has no effect
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
 
-        reg = re.compile( r'^(?=.*\b(?:' + "|".join(allRoomNames) + r')\b).*foo' )
+    def enqueue(self, customPath, folder_name, versionFile):
+        self.queue.put((customPath, folder_name, versionFile))
 
-        # Initial search to find related or similar rooms
-        if(re.search(newRoomRegex, room)):
+    # Number of versions waiting to be encoded
+    def pending(self):
+        return self.queue.qsize()
 
-            # String matching all rooms str with the value obtained from
-            # Return error message in the event it does not work
-            if(reg.findall(room)):
-                flash(ERR_same)
-                return redirect(url_for('create'))
-            
-            # Setting the room session variable to the created one
-            session["current_room"] = room
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                with app.app_context():
+                    encode_version(*job)
+            except Exception as e:
+                print("Version could not be stored as a delta", job, e)
+            finally:
+                self.queue.task_done()
 
-            # Create room directory
-            if not (os.path.exists( os.path.join(app.config["UPLOADED_PATH"], room) )):
-                os.mkdir((app.config["UPLOADED_PATH"]+"/"+room))
-            # Add new room to the roomList
-            with open(PATH_chats, "a", encoding = 'utf-8') as f:
-                f.write("{} : {}\n".format(room, passcode))
-            
-            # Check the timer value obtained from the form. 
-            if(not(duration >= 20000)):
-                thread = Thread(target = timer, args = (duration, room)) # !!!! TTL dropdown box 
-                thread.start()
-            
-            # forward to user to the created chat page
-            return redirect(url_for('chat'))
-        else:
 
-            # Error scenarios that return to the previous page
-            flash(ERR_word)
-            return redirect(url_for('create'))
-    
-    # default route when redirected to this page instead of a form request  
-    return render_template('create.html', template_folder='templates')
+deltas = DeltaEncoder()
 
 
 """
-    desc- The select route that allows users to select rooms that are already present
+    desc- returns the retention policy of a room as a dict with keep_last, keep_daily and max_bytes
+
+    param- the room name
 """
-@app.route('/select',methods=['POST','GET'])
-def select():
+def retention_policy(roomname):
+    policy = Retention.query.get(roomname)
+    if policy is not None:
+        return {"keep_last": policy.keep_last, "keep_daily": policy.keep_daily, "max_bytes": policy.max_bytes}
+    return {"keep_last": app.config["RETENTION_KEEP_LAST"], "keep_daily": app.config["RETENTION_KEEP_DAILY"],
+        "max_bytes": app.config["RETENTION_MAX_BYTES"]}
 
-    # Response to form POST request scenario
-    if request.method == 'POST':
 
-        # obtaining values from the FORM posted
-        room = request.form.get('links')
-        passcode = request.form.get('passcodes')
+"""
+    desc- returns the numbers of the versions a policy keeps. The newest version is always kept, keep_last and
+    keep_daily add versions and max_bytes then drops the oldest kept versions that do not fit
 
-        # Cross checking with the room file to find the appropriate group
-        with open(PATH_chats, encoding = 'utf-8') as f:
-            
-            # initial line read
-            line = f.readline()
-            while line:
-
-                # scenrio one, the lack of a pascode attached to the room
-                # in this scenario so long as the room exists it will be loaded in
-                # redirect to the chat page with the correct room as the reference
-                if(line.split(" : ")[0] == room):
-                    if not (line.split(" : ")[1]).strip():
-                        session["current_room"] = room
-                        return redirect(url_for('chat'))
-                    
-                    # scenario two, the room has a passcode and the input passcode
-                    # from the user is correct
-                    # redirect to the chat page with the correct room as the reference
-                    else:
-                        if ((line.split(" : ")[1]).strip() == passcode):
-                            session["current_room"] = room
-                            return redirect(url_for('chat'))
-                        
-                        # Incorrect passcode scenario, highlight the error and refresh the page
-                        else:
-                            flash(ERR_pass)
-                            line = f.readline()
-                            return redirect(url_for('select'))
+    param- the version rows newest first, the policy dict and the current UTC time
+"""
+def retained_versions(versions, policy, now):
+    keep = set([versions[0].number])
+    if policy["keep_last"] is None and policy["keep_daily"] is None:
+        keep.update(version.number for version in versions)
+    if policy["keep_last"]:
+        keep.update(version.number for version in versions[:policy["keep_last"]])
+    if policy["keep_daily"]:
+        days = set()
+        cutoff = now - timedelta(days=policy["keep_daily"])
+        for version in versions:
+            if version.uploaded_at >= cutoff and version.uploaded_at.date() not in days:
+                days.add(version.uploaded_at.date())
+                keep.add(version.number)
+
+    if policy["max_bytes"] is not None:
+        total = versions[0].size
+        for version in versions[1:]:
+            if version.number in keep:
+                if total + version.size > policy["max_bytes"]:
+                    keep.discard(version.number)
                 else:
-                    # If the line is not part of the room List then continue to the next line
-                    line = f.readline()
-                    continue
-            
-            # no room scenrio, highlight the error and refresh the page
-            flash(ERR_room)
-            return redirect(url_for('select'))
+                    total += version.size
+    return keep
 
-    # default route when redirected to this page instead of form request         
-    return render_template('select.html', template_folder='templates')
- 
 
 """
-    desc- The chat route common for all users that uses a roomname to dynamically
-    generate the contents in the room when redirected to.
-"""
-@app.route('/chat',methods=['POST','GET'])
-def chat():
-    # Initial PATH and name related fields
-    roomname = session["current_room"]
-    customPath = "" + app.config["UPLOADED_PATH"] + "/" + roomname
-    global current_chat
-    current_chat = session["current_room"]
-
-    # Scenario for when users enter and submit a message
-    if request.method == 'POST':
+    desc- removes the versions of a tracked file its retention policy no longer keeps: the file, its version row and its
+    blob reference. Snapshots that kept deltas are rebuilt from stay. Returns the number of versions removed and the
+    bytes given back to the disk, a file whose content is still shared with other files gives back nothing. The size
+    of every removed version is taken off the usage of the room in the same transaction
 
-        # Obtaining the message string from within the form
-        text = request.form.get('chatarea')
+    param- the room name and the version folder name
+"""
+def enforce_retention(roomname, folder_name):
+    policy = retention_policy(roomname)
+    if policy["keep_last"] is None and policy["keep_daily"] is None and policy["max_bytes"] is None:
+        return 0, 0
+    customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+    folder = os.path.join(customPath, folder_name)
+
+    removed = []
+    with file_lock(customPath, folder_name):
+        versions = Version.query.filter_by(room=roomname, folder=folder_name).order_by(Version.number.desc()).all()
+        if not versions:
+            return 0, 0
+        keep = retained_versions(versions, policy, datetime.utcnow())
+        for version in versions:
+            if version.number in keep and version.path.endswith(DELTA):
+                try:
+                    keep.add(int(delta_header(os.path.join(folder, version.path))["base"].split(".")[0]))
+                except (OSError, ValueError):
+                    pass
+
+        # A file gives its bytes back when it was its last link: it was never in the blob store or its blob
+        # was deleted along with it
+        reclaimed = 0
+        released = 0
+        with blobs_lock:
+            for version in versions:
+                if version.number in keep:
+                    continue
+                path = os.path.join(folder, version.path)
+                try:
+                    stat = os.stat(path)
+                    os.remove(path)
+                except OSError:
+                    stat = None
+                removed.append(path)
+                released += version.size
+                db.session.delete(version)
+                count, deleted = drop_blob_refs(os.path.relpath(path, app.config["UPLOADED_PATH"]))
+                if stat is not None and (stat.st_nlink == 1 or version.sha256 in deleted):
+                    reclaimed += stat.st_size
+            change_room_usage(roomname, -released)
+            db.session.commit()
 
-        print("Message Received", str(text))
+    return len(removed), reclaimed
 
-        if not text == "":
 
-            # Saving the message in a .txt file with a unique date related name
-            # format tEXt followed by the year month date hour minute and second
-            timestr = time.strftime("tEXt%Y%m%d-%H%M%S") + ".txt"
-            with open((customPath+"/"+timestr), "w") as f:
-                f.write(text)
+"""
+    desc- a background thread enforcing the retention policies. A tracked file is checked as soon as a new version of
+    it finishes and every tracked file is checked every RETENTION_INTERVAL seconds, RETENTION_BATCH files at a time so
+    a sweep never holds the registry for long. The versions removed and bytes reclaimed are counted for /stats
 
-    # Dynamic generation of content using files present in the room folder
-    keyCount = 0
-    chat_content = {}
+    param- none
+"""
+class RetentionCollector:
+    def __init__(self):
+        self.condition = Condition()
+        self.dirty = set()
+        self.thread = None
+        self.removed = 0
+        self.reclaimed = 0
+
+    # Starts the collector thread, calling it more than once has no effect
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # Asks for a tracked file to be checked soon
+    def touch(self, roomname, folder_name):
+        with self.condition:
+            self.dirty.add((roomname, folder_name))
+            self.condition.notify()
+
+    # Checks a list of tracked files and adds up what was removed
+    def collect(self, files):
+        removed = reclaimed = 0
+        for roomname, folder_name in files:
+            try:
+                with app.app_context():
+                    count, size = enforce_retention(roomname, folder_name)
+            except Exception as e:
+                print("Retention could not be enforced", roomname, folder_name, e)
+                continue
+            removed += count
+            reclaimed += size
+        with self.condition:
+            self.removed += removed
+            self.reclaimed += reclaimed
+        return removed, reclaimed
+
+    # Checks every tracked file, or those of one room, a batch at a time
+    def sweep(self, roomname=None):
+        removed = reclaimed = offset = 0
+        while True:
+            with app.app_context():
+                query = db.session.query(Version.room, Version.folder).distinct()
+                if roomname is not None:
+                    query = query.filter(Version.room == roomname)
+                files = query.order_by(Version.room, Version.folder).offset(offset).limit(app.config["RETENTION_BATCH"]).all()
+            count, size = self.collect(files)
+            removed += count
+            reclaimed += size
+            if len(files) < app.config["RETENTION_BATCH"]:
+                return removed, reclaimed
+            offset += len(files)
+
+    def stats(self):
+        with self.condition:
+            return self.removed, self.reclaimed
+
+    def run(self):
+        last_sweep = time.monotonic()
+        while True:
+            with self.condition:
+                timeout = app.config["RETENTION_INTERVAL"] - (time.monotonic() - last_sweep)
+                if not self.dirty and timeout > 0:
+                    self.condition.wait(timeout)
+                files, self.dirty = self.dirty, set()
+            self.collect(files)
+            if time.monotonic() - last_sweep >= app.config["RETENTION_INTERVAL"]:
+                self.sweep()
+                last_sweep = time.monotonic()
+
+
+retention = RetentionCollector()
 
-    directory = os.fsencode(app.config["UPLOADED_PATH"])
 
-    # Scanning section of the room to extract all the content from the file.    
-    for file in os.listdir(customPath):
-        filename = os.fsdecode(file)
-        if filename.startswith("tEXt"):
+"""
+    desc- finishes an upload without receiving any chunks when the blob store already holds its content: the blob is
+    hardlinked to the target of the upload, which is then finished like a fully received file. Returns False when the
+    content is not stored (anymore), the upload then carries on normally
 
-            # Unload string messages from each text file
-            with open((customPath + "/" + filename), "r", encoding = 'utf-8') as f:
-                data = f.read().replace('\n', ' ')
-            chat_content[("tEXt"+str(keyCount))] = data
-            keyCount+=1
+    param- the upload id and the upload record, expected_sha256 holds the SHA-256 of its content
+"""
+def link_upload(upload_id, upload):
+    sha256 = upload.get("expected_sha256")
+    if not sha256 or upload["complete"]:
+        return False
+    with blobs_lock:
+        blob = Blob.query.get(sha256)
+        if blob is None or blob.size != upload["size"]:
+            return False
+        target = upload_target(upload_id, upload)
+        temp = target + "." + secrets.token_hex(4)
+        try:
+            os.link(blob_path(sha256), temp)
+            os.replace(temp, target)
+        except OSError:
+            return False
+
+    uploads.fill(upload_id)
+    uploads.save(upload_id, upload, sha256=sha256, linked=True)
+    finish_upload(upload_id, upload)
+    return True
 
-        # Section to unload a version control file
-        elif(os.path.isdir(customPath+"/"+filename)):
-            # Create a path into the file folder
-            inner_dir_path = customPath + r"\\" + filename
-            inner_dir_path_contents = lister(inner_dir_path)
-            
-            # Extract the fike with the highest version number
-            inner_latest_file = max(inner_dir_path_contents, key=extract_file_number)
 
-            # Replace the version number name of a file with the original file
-            # replace 1.pdf with the original filename.pdf
-            real_filename = switchFiletoFolder(filename, "-", ".")
-            chat_content[real_filename+": Version "+getVersion(inner_latest_file)] = (inner_dir_path) 
+"""
+    desc- Not a Link tied to a webpage. Changes the timer of the room the session is in. The JSON body holds either
+    extend, the number of seconds to push the deadline back by, or cancel set to true so the room never expires.
+    Answers {"expires_at": the new deadline in UTC or null}, 409 when the room has no timer
+"""
+@app.route('/rooms/<roomname>/expiry', methods=['POST'])
+def room_expiry(roomname):
+    if session.get("current_room") != roomname:
+        return jsonify(error="not in this room"), 403
+    if not room_exists(roomname):
+        return jsonify(error="unknown room"), 404
+
+    details = request.get_json(force=True)
+    if details.get("cancel"):
+        if not expiry.cancel(roomname):
+            return jsonify(error="room has no timer"), 409
+        bump_room_version(roomname)
+        return jsonify(expires_at=None)
+
+    try:
+        seconds = int(details.get("extend"))
+    except (TypeError, ValueError):
+        return jsonify(error="extend must be a number of seconds"), 400
+    if seconds <= 0:
+        return jsonify(error="extend must be a number of seconds"), 400
+    deadline = expiry.extend(roomname, seconds)
+    if deadline is None:
+        return jsonify(error="room has no timer"), 409
+    bump_room_version(roomname)
+    return jsonify(expires_at=deadline.isoformat() + "Z")
 
-        else:
-            # Final scenario for stand alone files and ZIP files
-            chat_content[filename] = (customPath + "/" + filename)
-            keyCount+=1
-        
-    return render_template('chat_template.html', template_folder='templates', var=roomname, dict_item=chat_content)
 
+"""
+    desc- Not a Link tied to a webpage. Tells whether the blob store holds a file with the given SHA-256, so a client
+    can skip sending a file the server already has. Answers 200 with the size of the blob or 404
+"""
+@app.route('/blobs/<sha256>', methods=['HEAD'])
+def blob_exists(sha256):
+    sha256 = sha256.lower()
+    blob = Blob.query.get(sha256) if re.match("^[0-9a-f]{64}$", sha256) else None
+    if blob is None or not os.path.exists(blob_path(sha256)):
+        return ('', 404)
+    return ('', 200, {"Blob-Size": str(blob.size), "Cache-Control": "no-store"})
 
-currentHighestVersion = 0
-fileContinuity = False
 
 """
     desc- The options route that allows you to customise the file upload options such as compression and
@@ -361,14 +2591,8 @@ fileContinuity = False
 def options():
     # Initial PATH and name related fields
     roomname = session["current_room"]
-    customPath = r"" + app.config["UPLOADED_PATH"] + r"\\" + roomname
-    relativePath = "content/tempZipFiles"
-    dir_contents = []
+    customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
     fileNumbers = 0
-    global fileContinuity
-    session["fileContinuity"] = fileContinuity
-
-    dir_contents = lister(customPath)
 
     # After form post scenario to handle file uploads
     if request.method == 'POST':
@@ -378,123 +2602,217 @@ def options():
         zipname = request.form.get("links")
         fileNumbers = int(request.form.get("Numfiles"))
 
-        # Chekc if there are any files
-        #print(request.form)
-        #print(request.files.getlist("filesInput"))
-        #print(checks, zipname)
+        # Multipart chunks as Dropzone posted them before the page moved to the raw chunk API (/upload, /batch).
+        # The options page no longer sends these, the branch is kept only so uploads from pages loaded by
+        # older clients can still finish
+        if len(request.files.getlist("filesInput")) > 0:
+            # Chunk details sent by Dropzone, chunks of a file may arrive in any order
+            tempFile = request.files["filesInput"]
+            upload_id = request.form["dzuuid"]
+            current_chunk = int(request.form['dzchunkindex'])
+            total_chunks = int(request.form["dztotalchunkcount"])
+            total_size = int(request.form.get("dztotalfilesize", 0))
+            chunk_size = int(request.form.get("dzchunksize", total_size))
+            upload = uploads.start(upload_id, total_chunks)
+
+            # A chunk that was already saved (a retry or a resumed upload) is acknowledged without writing it again
+            if upload.get("error"):
+                return ('', 409)
+            if uploads.has_chunk(upload, current_chunk):
+                return ('', 200)
+
+            # The details of the file are sent with every chunk, they are only saved when they change
+            zipname = secure_filename(zipname or "") if checks else None
+            uploads.save(upload_id, upload, room=roomname, filename=os.path.basename(tempFile.filename),
+                size=total_size, chunk_size=chunk_size, zipname=zipname or None,
+                note=request.form.get(tempFile.filename+"textarea") or "")
+
+            # Dropzone posts the files of a zip file as separate uploads, they share a batch named after the
+            # room and the zip file with one slot for each of the Numfiles files
+            if upload["zipname"] and upload.get("batch") is None:
+                batch_id = secure_filename(roomname+"-"+upload["zipname"])
+                uploads.start_batch(batch_id, roomname, upload["zipname"], fileNumbers)
+                if not uploads.join_batch(batch_id, upload_id, upload):
+                    return ('', 409)
+
+            try:
+                written = receive_chunk(upload_id, upload, current_chunk, tempFile.stream)
+            except OSError:
+                print("File writing error")
+                return ('', 500)
+            if upload.get("error"):
+                return ('', 409)
+
+            bump_room_version(roomname)
 
+    # Provide a reference list for verion tracked files so these the status of these files can be tracked
+    # client side for less load on the server
+    reference = []
+    for entry in read_manifest(customPath, roomname)["entries"].values():
+        if entry["type"] == "tracked":
+            reference.append( entry["name"] )
+    return render_template('options.html', template_folder='templates', reference=reference, room=roomname)
 
-        if len(request.files.getlist("filesInput")) > 0:
-            # obtain a filelist from the client of files sent
-            files = request.files.getlist("filesInput")
-            folder_name=""
-
-            # Scenario for packing multiple files into a compressed tarfile
-            if checks == True:
-                # Create a temporary refuge for the files to save into before being
-                # compressed into a tarfile
-                if not os.path.isdir(PATH_tempfiles):
-                    os.mkdir(PATH_tempfiles)
-                
-                tempFile = request.files["filesInput"]
-                current_chunk = int(request.form['dzchunkindex'])
-                total_chunks = int(request.form["dztotalchunkcount"])
-
-                if not os.path.exists(os.path.join(PATH_tempfiles, secure_filename(zipname))):
-                    os.mkdir(os.path.join(PATH_tempfiles, secure_filename(zipname)))
 
-                try:
-                    with open( os.path.join(PATH_tempfiles, secure_filename(zipname), tempFile.filename) , 'ab') as f:
-                        f.seek(int(request.form['dzchunkbyteoffset']))
-                        f.write(tempFile.stream.read())
-                except OSError:
-                    print("File writing error")
+"""
+    desc- Not a Link tied to a webpage. Starts an upload of the raw chunk API. The details of the file are
+    posted once as JSON (filename, size, chunk_size, note and optionally the sha256 the file must match) and the
+    chunks are then sent with PUT /upload/<upload_id>/<chunk_index>. With link set, a file whose sha256 is in the
+    blob store is linked from it straight away and no chunks are needed. Posting an existing upload_id resumes that upload
+"""
+@app.route('/upload', methods=['POST'])
+def create_upload():
+    details = request.get_json(force=True)
+    roomname = session["current_room"]
+    filename = os.path.basename(details["filename"])
+    size = int(details["size"])
+    chunk_size = int(details["chunk_size"])
+    if not filename or size < 0 or chunk_size <= 0:
+        return jsonify(error="invalid upload"), 400
+    if not room_exists(roomname):
+        return jsonify(error=ERR_expired), 410
+
+    upload_id = details.get("upload_id")
+    upload = uploads.find(upload_id) if upload_id else None
+    if upload is None or upload.get("room") != roomname or upload.get("filename") != filename or upload.get("size") != size:
+        upload_id = secrets.token_hex(16)
+        upload = uploads.start(upload_id, max(1, -(-size // chunk_size)))
+        uploads.save(upload_id, upload, room=roomname, filename=filename, size=size, chunk_size=chunk_size,
+            note=details.get("note") or "", expected_sha256=(details.get("sha256") or "").lower() or None)
+        if details.get("link"):
+            link_upload(upload_id, upload)
+            if upload.get("error") == ERR_expired:
+                return jsonify(error=ERR_expired), 410
+
+    received = uploads.chunks(upload)
+    return jsonify(upload_id=upload_id, total=len(upload["bitmap"]), received=received, complete=upload["complete"])
 
-                if (current_chunk+1) >= total_chunks:
-                    currentUploads = len([name for name in os.listdir( os.path.join(PATH_tempfiles, secure_filename(zipname)) )])
-                    print(currentUploads, fileNumbers)
-                    if (currentUploads >= fileNumbers):
-                        print("All files done")
-                        with tarfile.open(os.path.join(customPath, secure_filename(zipname))+".tar.gz", "w:gz") as tar_handle:
-                            tar_handle.add(os.path.join(relativePath, secure_filename(zipname)))
 
-                            # Remove these temporary files after being added to the tarfile
-                            shutil.rmtree(os.path.join(PATH_tempfiles, secure_filename(zipname)))
+"""
+    desc- Not a Link tied to a webpage. Starts a batch of the raw chunk API, the files dropped together. The JSON
+    body lists the files (filename, size, chunk_size, note and optionally sha256 and link of each) plus compress and zipname
+    to pack them into a tarfile. Every file gets an upload in its own slot of the batch and their chunks are sent concurrently
+    with PUT /upload/<upload_id>/<chunk_index>, files with link set whose sha256 is in the blob store are linked from it and
+    need no chunks. Posting an existing batch_id resumes that batch
+"""
+@app.route('/batch', methods=['POST'])
+def create_batch():
+    details = request.get_json(force=True)
+    roomname = session["current_room"]
+    files = details.get("files") or []
+    for file in files:
+        if not os.path.basename(file["filename"]) or int(file["size"]) < 0 or int(file["chunk_size"]) <= 0:
+            return jsonify(error="invalid upload"), 400
+    if not files:
+        return jsonify(error="empty batch"), 400
+    if not room_exists(roomname):
+        return jsonify(error=ERR_expired), 410
+
+    batch_id = details.get("batch_id")
+    batch = uploads.find_batch(batch_id) if batch_id else None
+    if batch is None or batch["room"] != roomname or batch["finished"] or len(batch["slots"]) != len(files):
+        batch_id = secrets.token_hex(16)
+        zipname = secure_filename(details.get("zipname") or "") if details.get("compress") else None
+        uploads.start_batch(batch_id, roomname, zipname or None, len(files))
+        for file in files:
+            upload_id = secrets.token_hex(16)
+            size = int(file["size"])
+            upload = uploads.start(upload_id, max(1, -(-size // int(file["chunk_size"]))))
+            uploads.save(upload_id, upload, room=roomname, filename=os.path.basename(file["filename"]), size=size,
+                chunk_size=int(file["chunk_size"]), zipname=zipname or None, note=file.get("note") or "",
+                expected_sha256=(file.get("sha256") or "").lower() or None)
+            uploads.join_batch(batch_id, upload_id, upload)
+            if file.get("link"):
+                link_upload(upload_id, upload)
+
+    return jsonify(uploads.batch_status(batch_id))
 
-            # In the event of no compression option and storing files as Version control objects
-            else:
-                tempFile = request.files["filesInput"]
-                folder_name = switchFiletoFolder(tempFile.filename, ".", "-")
-                current_chunk = int(request.form['dzchunkindex'])
-                total_chunks = int(request.form["dztotalchunkcount"])
-
-                if folder_name in dir_contents:
-                    roomContents = lister2( os.path.join( customPath, folder_name ) )
-
-                    #print(os.path.join( customPath, folder_name ))
-                    highestVersion = ""
-                    innerFiles = []
-
-                    if current_chunk == 0 or session["fileContinuity"]:
-                        # The if/else exists for in the event with no extension is added to the program
-                        try:
-                            innerFiles = [int(x.split(".")[0]) if "." in x else int(x) for x in roomContents]
-                        except ValueError:
-                            print("Value Error anticipated")
-                        
-                        if(session["fileContinuity"]):
-                            highestVersion = str(max(innerFiles))
-                            session["currentVersion"] = highestVersion
-                        else:
-                            highestVersion = str(max(innerFiles)+1)
-                            session["currentVersion"] = highestVersion
-                        
-                        print("new highest", highestVersion, fileContinuity, session["fileContinuity"])
-
-                    
-                    print("Session vriables here:", session["currentVersion"])
-                    with open( os.path.join( customPath, folder_name, (str(session["currentVersion"])+"."+
-                    (tempFile.filename.split(".")[1] if "." in tempFile.filename else "")  ) ) , 'ab') as f:
-                        f.seek(int(request.form['dzchunkbyteoffset']))
-                        f.write(tempFile.stream.read())
-
-                    if (current_chunk+1) >= total_chunks:
-                        VersionInfoPath = os.path.join( customPath, folder_name, "VersionInfo/VersionInfo.txt")
-                        currentChanges = request.form.get(tempFile.filename+"textarea")
-                        temp_strs = currentChanges.replace("\n", " ") + "\n"
-                        fileContinuity = False
-                        
-                        with open( VersionInfoPath, 'a') as f:
-                            f.write("Version "+session["currentVersion"] +": "+temp_strs)
 
-                else:
-                    if current_chunk == 0:
-                        # Make the related files and folders required for version control
-                        os.mkdir( os.path.join(customPath, folder_name) )
-                        os.mkdir( os.path.join(customPath, folder_name, "VersionInfo") )
-
-                    
-                    with open( os.path.join( customPath, folder_name, ("1." +
-                    (tempFile.filename.split(".")[1] if "." in tempFile.filename else "") ) ), 'ab') as f:
-                            f.seek(int(request.form['dzchunkbyteoffset']))
-                            f.write(tempFile.stream.read())
-                    
-                    fileContinuity = True
-
-                    if (current_chunk+1) >= total_chunks:
-                        VersionInfoPath = os.path.join( customPath, folder_name, "VersionInfo/VersionInfo.txt")
-                        currentChanges = request.form.get(tempFile.filename+"textarea")
-                        temp_strs = currentChanges.replace("\n", " ") + "\n"
-                        with open( VersionInfoPath, 'a') as f:
-                            f.write("Version 1: "+ temp_strs)
+"""
+    desc- Not a Link tied to a webpage. Reports the progress of every file of a batch and whether the batch is complete
+"""
+@app.route('/batch/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    status = uploads.batch_status(batch_id)
+    if status is None:
+        return jsonify(error="unknown batch"), 404
+    response = jsonify(status)
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+"""
+    desc- Not a Link tied to a webpage. Receives one chunk of the raw chunk API as an application/octet-stream body
+    and streams it straight to its offset in the target file, there is no multipart form to parse
+"""
+@app.route('/upload/<upload_id>/<int:chunk_index>', methods=['PUT'])
+def upload_chunk(upload_id, chunk_index):
+    upload = uploads.find(upload_id)
+    if upload is None or "chunk_size" not in upload or chunk_index >= len(upload["bitmap"]):
+        return jsonify(error="unknown upload or chunk"), 404
+
+    if upload.get("error"):
+        return jsonify(error=upload["error"]), 409
+    if not room_exists(upload["room"]):
+        drop_expired_upload(upload_id, upload)
+        return jsonify(error=ERR_expired), 410
+    if uploads.has_chunk(upload, chunk_index):
+        return jsonify(complete=upload["complete"], sha256=upload.get("sha256"))
+
+    offset = chunk_index * upload["chunk_size"]
+    expected = min(upload["chunk_size"], upload["size"] - offset)
+    if request.content_length is not None and request.content_length != expected:
+        return jsonify(error="chunk {} must be {} bytes".format(chunk_index, expected)), 400
+
+    written = receive_chunk(upload_id, upload, chunk_index, request.stream)
+    if written != expected:
+        return jsonify(error="chunk {} was cut short".format(chunk_index)), 400
+    if upload.get("error"):
+        return jsonify(error=upload["error"]), 410 if upload["error"] == ERR_expired else 409
+
+    bump_room_version(upload["room"])
+    return jsonify(complete=upload["complete"], sha256=upload.get("sha256"))
 
-    # Provide a reference list for verion tracked files so these the status of these files can be tracked
-    # client side for less load on the server
-    reference = []
-    for file in os.listdir(customPath):
-        if os.path.isdir(os.path.join(customPath, os.fsdecode(file))):
-            reference.append( switchFiletoFolder(os.fsdecode(file), '-', '.') )
-    return render_template('options.html', template_folder='templates', reference=reference)
+
+"""
+    desc- Not a Link tied to a webpage. Reports which chunks of an upload the server already has so an interrupted
+    upload can skip them when it is resumed. HEAD only sends the counts as headers
+"""
+@app.route('/uploads/<dzuuid>', methods=['GET','HEAD'])
+def upload_status(dzuuid):
+    upload = uploads.find(dzuuid)
+    if upload is None:
+        return jsonify(error="unknown upload"), 404
+
+    received = uploads.chunks(upload)
+    response = jsonify(total=len(upload["bitmap"]), received=received, written=upload["written"], complete=upload["complete"],
+        sha256=upload.get("sha256"), error=upload.get("error"))
+    response.headers["Upload-Chunks-Received"] = str(len(received))
+    response.headers["Upload-Chunks-Total"] = str(len(upload["bitmap"]))
+    response.headers["Upload-Complete"] = "true" if upload["complete"] else "false"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+"""
+    desc- returns one page of the versions of a tracked file, newest first, plus the cursor of the next page. The cursor
+    is the number of the last version on the page and the next page starts below it, so pages stay put while new
+    versions are added. It is None after the last page
+
+    param- the room name, the version folder name, the cursor (None for the newest versions) and the page size
+"""
+def version_page(roomname, folder_name, cursor=None, limit=VERSIONS_PAGE):
+    query = Version.query.filter_by(room=roomname, folder=folder_name)
+    if cursor is not None:
+        query = query.filter(Version.number < cursor)
+    rows = query.order_by(Version.number.desc()).limit(limit + 1).all()
+
+    page = []
+    for version in rows[:limit]:
+        page.append({"number": version.number, "file": version.path[:-len(DELTA)] if version.path.endswith(DELTA) else version.path,
+            "note": version.note, "size": version.size, "sha256": version.sha256,
+            "uploaded_at": version.uploaded_at.isoformat() + "Z"})
+    return page, (rows[limit - 1].number if len(rows) > limit else None)
 
 
 """
@@ -503,76 +2821,264 @@ def options():
 """
 @app.route('/versions/',methods=['POST','GET'])
 def versions():
-    versionContent = {}
 
     # Get the form posted with the user's requested file version
     if request.method == 'POST':
         folder_name = session["parent_directory"]
         filename = request.form.get("versions")
+        version = Version.query.filter_by(room=os.path.basename(os.path.dirname(folder_name)),
+            folder=os.path.basename(folder_name), number=int(filename.split(".")[0])).first()
+        if version is None:
+            abort(404)
 
         # Get the real filename from the folder name and download with that name
         original_name = os.path.basename(folder_name + "/" + switchFiletoFolder(os.path.basename(folder_name), "-", "."))
-        return send_file((folder_name+"/"+filename), as_attachment=True, download_name=original_name)
+        path = os.path.join(folder_name, version.path)
+        if version.path.endswith(DELTA):
+            # A version stored as a delta is rebuilt from its snapshot while it is sent
+            response = Response(delta_chunks(folder_name, path), mimetype="application/octet-stream")
+            response.headers.set("Content-Disposition", "attachment", filename=original_name)
+            response.headers["Content-Length"] = str(version.size)
+        else:
+            response = send_file(path, as_attachment=True, download_name=original_name)
+
+        # Versions uploaded with a checksum carry it so the client can verify the download
+        if version.sha256:
+            response.headers["Digest"] = "sha-256=" + base64.b64encode(bytes.fromhex(version.sha256)).decode()
+            response.set_etag(version.sha256)
+        return response
     
     folder_name = request.args.get('data-status')
     session["parent_directory"] = folder_name
 
     # Scenario to generate the page initially if the file is a version control file render the HTML page
-    # If not just return the file using the PATH
+    # If not just return the file using the PATH. The page opens with the newest versions and loads older
+    # ones from the versions API
     if(os.path.isdir(folder_name)):
-        temp = lister2(folder_name)
-        inner_dir_path_contents = [int(x.split(".")[0]) if "." in x else int(x) for x in temp]
-
-        for index in temp:
-            tempStr = "Version "+str(int(index.split(".")[0]) if "." in index else int(index))
-            versionContent[index] = lineExtractor(tempStr, (folder_name+"/"+"VersionInfo/VersionInfo.txt"))
+        roomname = os.path.basename(os.path.dirname(folder_name))
+        versionContent, cursor = version_page(roomname, os.path.basename(folder_name))
 
-        return render_template('versions.html', template_folder='templates', versions = versionContent)
+        return render_template('versions.html', template_folder='templates', versions = versionContent,
+            room = roomname, file = os.path.basename(folder_name), cursor = cursor)
     else:
         return send_file(folder_name)
 
 
 
 """
-    desc- Not a Link tied to a webpage. The link is used to update the webpage with activity from new users
-    It contains the same commands as the chat codes
+    desc- Not a Link tied to a webpage. Lists the versions of a tracked file newest first, a page at a time. The file
+    is given by its name or its version folder name, ?cursor= takes the next_cursor of the previous page and ?limit=
+    the page size. Answers {"versions": [...], "next_cursor": number or null}
+"""
+@app.route('/versions/<roomname>/<filename>', methods=['GET'])
+def versions_api(roomname, filename):
+    if not room_exists(roomname):
+        return jsonify(error="unknown room"), 404
+    try:
+        cursor = int(request.args["cursor"]) if request.args.get("cursor") else None
+        limit = min(max(int(request.args.get("limit", VERSIONS_PAGE)), 1), VERSIONS_PAGE_MAX)
+    except ValueError:
+        return jsonify(error="invalid cursor or limit"), 400
+
+    page, next_cursor = version_page(roomname, switchFiletoFolder(filename, ".", "-"), cursor, limit)
+    response = jsonify(versions=page, next_cursor=next_cursor)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+"""
+    desc- Not a Link tied to a webpage. The link is used to update the webpage with activity from new users.
+    With a "since" cursor only the messages and uploads newer than the cursor are returned together with the
+    new cursor, without one the whole room is returned like the chat page
 """
 @app.route('/updater', methods=['POST','GET'])
 def update():
-    if request.method == 'POST':
-        roomname = str(request.get_data()).split("/")[1]
-        customPath = r"" + app.config["UPLOADED_PATH"] + "/" + (str(roomname)[:-1]).strip()
-        keyCount = 0
-        chat_content = {}
-
-        if os.path.exists(customPath):
-            for file in os.listdir(customPath):
-                filename = os.fsdecode(file)
-                if filename.startswith("tEXt"): 
-                    with open((customPath + "/" + filename), "r", encoding = 'utf-8') as f:
-                        data = f.read().replace('\n', ' ')
-                    chat_content[("tEXt"+str(keyCount))] = data
-                    keyCount+=1
-
-                elif(os.path.isdir(customPath+"/"+filename)):
-                    inner_dir_path = customPath + r"\\" + filename
-                    inner_dir_path_contents = lister(inner_dir_path)
-                    
-                    inner_latest_file = max(inner_dir_path_contents, key=extract_file_number)
-
-                    real_filename = switchFiletoFolder(filename, "-", ".")
-
-                    chat_content[real_filename+": Version "+getVersion(inner_latest_file)] = (inner_dir_path) 
+    # The room comes from the "room" argument or, for older pages, the posted "bitBybit/<room>" title
+    if request.method == 'POST' and request.args.get("room") is None:
+        roomname = (str(request.get_data()).split("/")[1])[:-1].strip()
+    else:
+        roomname = request.args.get("room", "").strip()
+
+    # Only names a room could have get a folder path and an ETag (which cannot hold quotes)
+    if not re.search(newRoomRegex, roomname):
+        return jsonify(error="unknown room"), 404
+    customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+
+    # Nothing was written to the room since the caller's copy, answer before touching the disk
+    etag = room_etag(roomname)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    if request.args.get("since") is not None:
+        try:
+            since = int(request.args.get("since"))
+        except ValueError:
+            return jsonify(error="invalid cursor"), 400
+        if not os.path.exists(customPath):
+            return jsonify(cursor=since, entries=[], deleted='"{}" timer has expired'.format(roomname))
+
+        entries = [entry_payload(record) for record in read_messages(customPath, after=since)]
+        response = jsonify(cursor=entries[-1]["seq"] if entries else since, entries=entries)
+        response.set_etag(etag)
+        return response
+
+    if os.path.exists(customPath):
+        chat_content = room_listing(customPath, roomname)
+    else:
+        chat_content = {"DELETED": '"{}" timer has expired'.format(roomname)}
 
-                else:
-                    chat_content[filename] = (customPath + "/" + filename)
-                    keyCount+=1
+    #print(chat_content)
+    response = make_response(json.dumps(chat_content))
+    response.set_etag(etag)
+    return response
+
+
+"""
+    desc- Not a Link tied to a webpage. A Server-Sent Events stream of the new messages and uploads of a room.
+    Every event carries the sequence number of its record as id, so a reconnecting browser resumes from
+    Last-Event-ID (or from the "since" argument on the first connection) without missing anything
+"""
+@app.route('/events/<roomname>')
+def events(roomname):
+    customPath = os.path.join(app.config["UPLOADED_PATH"], roomname)
+    last = request.headers.get("Last-Event-ID") or request.args.get("since")
+    # A missing or malformed cursor starts the stream at the newest message
+    try:
+        cursor = int(last)
+    except (TypeError, ValueError):
+        cursor = message_count(customPath)
+
+    def stream(cursor):
+        # Subscribe before catching up so nothing written in between is lost
+        q = hub.subscribe(roomname)
+        try:
+            yield "retry: 5000\n\n"
+            if not os.path.exists(customPath):
+                yield "event: deleted\ndata: {}\n\n".format(json.dumps('"{}" timer has expired'.format(roomname)))
+                return
+
+            for record in read_messages(customPath, after=cursor):
+                cursor = record["seq"]
+                yield "id: {}\ndata: {}\n\n".format(cursor, json.dumps(entry_payload(record)))
+
+            while True:
+                try:
+                    record = q.get(timeout=EVENTS_HEARTBEAT)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                if record["type"] == "deleted":
+                    yield "event: deleted\ndata: {}\n\n".format(json.dumps(record["text"]))
+                    return
+                if record["seq"] <= cursor:
+                    continue
+                cursor = record["seq"]
+                yield "id: {}\ndata: {}\n\n".format(cursor, json.dumps(entry_payload(record)))
+        finally:
+            hub.unsubscribe(roomname, q)
+
+    return Response(stream(cursor), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+"""
+    desc- Not a Link tied to a webpage. Reports the state of the background workers as JSON
+"""
+@app.route('/stats')
+def stats():
+    removed, reclaimed = retention.stats()
+    return jsonify(pending_expiries=expiry.pending(), pending_deletions=reaper.pending(), listeners=hub.listeners(),
+        active_uploads=uploads.active(), pending_deltas=deltas.pending(), blobs=Blob.query.count(),
+        blob_bytes=db.session.query(db.func.coalesce(db.func.sum(Blob.size), 0)).scalar(),
+        retention_removed_versions=removed, retention_reclaimed_bytes=reclaimed)
+
+
+"""
+    desc- Command line entry point (flask import-chatrooms) to import a chatrooms.txt file into the room registry
+"""
+@app.cli.command("import-chatrooms")
+@click.argument("path", default=PATH_chats)
+def import_chatrooms_command(path):
+    print("Imported", import_chatrooms(path), "rooms")
+
+
+"""
+    desc- Command line entry point (flask migrate-messages) to move tEXt message files into the message logs
+"""
+@app.cli.command("migrate-messages")
+def migrate_messages_command():
+    print("Migrated", migrate_all_messages(), "messages")
+
+
+"""
+    desc- Command line entry point (flask migrate-versions) to copy VersionInfo.txt notes into the version table
+"""
+@app.cli.command("migrate-versions")
+def migrate_versions_command():
+    print("Migrated", migrate_all_versions(), "versions")
+
+
+"""
+    desc- Command line entry point (flask set-retention) to give a room its own retention policy, rules left out are
+    switched off for the room. --clear puts the room back on the global policy
+"""
+@app.cli.command("set-retention")
+@click.argument("room")
+@click.option("--keep-last", type=int, default=None)
+@click.option("--keep-daily", type=int, default=None)
+@click.option("--max-bytes", type=int, default=None)
+@click.option("--clear", is_flag=True)
+def set_retention_command(room, keep_last, keep_daily, max_bytes, clear):
+    Retention.query.filter_by(room=room).delete()
+    if not clear:
+        db.session.add(Retention(room=room, keep_last=keep_last, keep_daily=keep_daily, max_bytes=max_bytes))
+    db.session.commit()
+    print("Retention of", room, retention_policy(room))
+
+
+"""
+    desc- Command line entry point (flask enforce-retention) to apply the retention policies now, to every room or one
+"""
+@app.cli.command("enforce-retention")
+@click.argument("room", required=False)
+def enforce_retention_command(room):
+    removed, reclaimed = retention.sweep(room)
+    print("Removed", removed, "versions and reclaimed", reclaimed, "bytes")
+
+
+"""
+    desc- Command line entry point (flask rebuild-manifest) to regenerate room manifests from the folder tree
+"""
+@app.cli.command("rebuild-manifest")
+@click.argument("room", required=False)
+def rebuild_manifest_command(room):
+    print("Rebuilt", rebuild_manifests(room), "manifests")
+
+
+# Prepare the content folders and the room registry when the program is loaded, the command line commands
+# need them as well
+setup_storage()
 
-        else:
-            chat_content["DELETED"] = "".format('"{}" timer has expired ', roomname)
 
-        #print(chat_content)
-        return json.dumps(chat_content)
+"""
+    desc- starts the background workers: drops stale uploads, picks up the deadlines and the pending folder deletions
+    saved by an earlier run and starts the expiry scheduler, the reaper, the delta encoder and the retention collector.
+    It runs before the first request the server answers, so importing the program (flask commands, benchmarks, the
+    reloader's watcher process) never expires or deletes anything. Deadlines are flushed when the program exits
+
+    param- none
+"""
+@app.before_first_request
+def start_workers():
+    uploads.expire(force=True)
+    load_deadlines()
+    load_reaping()
+    expiry.start()
+    reaper.start()
+    deltas.start()
+    retention.start()
+    atexit.register(expiry.stop)
 
 
 """
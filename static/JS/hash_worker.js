@@ -0,0 +1,109 @@
+// Web Worker computing the SHA-256 of a file for the uploader. The file is read in slices and fed to an
+// incremental SHA-256 so hashing a large file neither blocks the page nor loads the whole file into memory.
+// Post {id, file} to it, it answers with {id, progress} while reading and {id, sha256} or {id, error} at the end.
+
+var SLICE_SIZE = 4 * 1024 * 1024;
+
+var K = new Uint32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+// Incremental SHA-256: update() takes any number of Uint8Arrays, hex() pads the message and returns the digest
+function Sha256() {
+    this.h = new Uint32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+    this.w = new Uint32Array(64);
+    this.buffer = new Uint8Array(64);
+    this.buffered = 0;
+    this.length = 0;
+}
+
+// Compresses the 64 byte block of data starting at offset into the state
+Sha256.prototype.block = function(data, offset) {
+    var w = this.w, h = this.h;
+    for (let i = 0; i < 16; i++){
+        let j = offset + i * 4;
+        w[i] = (data[j] << 24) | (data[j + 1] << 16) | (data[j + 2] << 8) | data[j + 3];
+    }
+    for (let i = 16; i < 64; i++){
+        let x = w[i - 15], y = w[i - 2];
+        let s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+        let s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+    }
+
+    let a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], f = h[5], g = h[6], k = h[7];
+    for (let i = 0; i < 64; i++){
+        let S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+        let t1 = (k + S1 + ((e & f) ^ (~e & g)) + K[i] + w[i]) | 0;
+        let S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+        let t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+        k = g; g = f; f = e; e = (d + t1) | 0;
+        d = c; c = b; b = a; a = (t1 + t2) | 0;
+    }
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d;
+    h[4] += e; h[5] += f; h[6] += g; h[7] += k;
+};
+
+Sha256.prototype.update = function(data) {
+    var offset = 0;
+    this.length += data.length;
+
+    // Top up a partly filled block first, then compress whole blocks straight from data
+    if (this.buffered){
+        let take = Math.min(64 - this.buffered, data.length);
+        this.buffer.set(data.subarray(0, take), this.buffered);
+        this.buffered += take;
+        offset = take;
+        if (this.buffered < 64){
+            return;
+        }
+        this.block(this.buffer, 0);
+        this.buffered = 0;
+    }
+    for (; offset + 64 <= data.length; offset += 64){
+        this.block(data, offset);
+    }
+    this.buffer.set(data.subarray(offset), 0);
+    this.buffered = data.length - offset;
+};
+
+Sha256.prototype.hex = function() {
+    // Padding: a 1 bit, zeros up to 56 bytes into a block, then the message length in bits as 64 bits
+    var bits_high = Math.floor(this.length / 0x20000000), bits_low = (this.length % 0x20000000) * 8;
+    var padding = new Uint8Array((this.buffered < 56 ? 56 : 120) - this.buffered + 8);
+    padding[0] = 0x80;
+    for (let i = 0; i < 4; i++){
+        padding[padding.length - 8 + i] = (bits_high >>> (24 - i * 8)) & 0xff;
+        padding[padding.length - 4 + i] = (bits_low >>> (24 - i * 8)) & 0xff;
+    }
+    this.update(padding);
+
+    var digest = "";
+    for (let i = 0; i < 8; i++){
+        digest += ("00000000" + this.h[i].toString(16)).slice(-8);
+    }
+    return digest;
+};
+
+self.onmessage = async function(event) {
+    var id = event.data.id, file = event.data.file;
+    try {
+        var sha = new Sha256();
+        for (let offset = 0; offset < file.size; offset += SLICE_SIZE){
+            let slice = await file.slice(offset, offset + SLICE_SIZE).arrayBuffer();
+            sha.update(new Uint8Array(slice));
+            self.postMessage({id: id, progress: Math.min(file.size, offset + SLICE_SIZE) / file.size});
+        }
+        self.postMessage({id: id, sha256: sha.hex()});
+    }
+    catch (error) {
+        self.postMessage({id: id, error: String(error)});
+    }
+};
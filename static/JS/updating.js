@@ -1,48 +1,107 @@
 console.log("Imported Successfully");
 
 var repeater;
-var newval = ``;
+var events;
 var roomname = document.querySelector(".subtitle");
+var content = document.querySelector(".content");
+// Sequence number of the newest message or upload shown on the page
+var cursor = parseInt(content.dataset.cursor || "0");
+// ETag of the last poll, unchanged rooms answer with an empty 304
+var etag = null;
 console.log(roomname.innerHTML);
 
-function doWork() {
-    $.ajax({
-        url: '/updater',
-        data: roomname.innerHTML,
-        type: 'POST',
-        dataType: 'json',
-
-        success: function(response){
-            $.each(response, function( index, value ) {
-                if (index.startsWith('tEXt')){
-                    newval += `<div class="msgboxes tri-right left-top"> ${value} </div>`;
-                }
-
-                else if(index.startsWith('DEL')){
-                    newval += `<div class="msgboxes tri-right left-top"> ${value} </div>`;
-                }
+function messageBox(value) {
+    return `<div class="msgboxes tri-right left-top"> ${value} </div>`;
+}
 
-                else {
-                    newval += `<div class="msgboxes tri-right left-top">
+function fileBox(index, value) {
+    return `<div class="msgboxes tri-right left-top">
                     <a class="point" href="/versions/?data-status=${value}">
                             <div class="iamge"></div>
                             <input name="retrieval" class="retrieval" value="${index}" type="submit">${index}
                     </a>
                 </div>`;
+}
+
+// Adds the new entries to the end of the page, a new version of a tracked file replaces the old one
+function addEntries(entries) {
+    $.each(entries, function( index, entry ) {
+        if (entry.seq <= cursor){
+            return;
+        }
+        if (entry.type === 'message'){
+            content.insertAdjacentHTML('beforeend', messageBox(entry.value));
+        }
+        else {
+            $(content).find(".retrieval").each(function(){
+                if (this.value === entry.file || this.value.startsWith(entry.file + ": Version")){
+                    $(this).closest(".msgboxes").remove();
                 }
             });
-            document.querySelector(".content").innerHTML = newval;
-            newval="";
-            console.log(newval);
+            content.insertAdjacentHTML('beforeend', fileBox(entry.key, entry.value));
+        }
+        cursor = entry.seq;
+    });
+}
+
+function roomDeleted(text) {
+    content.innerHTML = messageBox(text);
+}
+
+// Fallback for browsers without EventSource or when the stream cannot be opened, polls every 5 seconds
+function doWork() {
+    $.ajax({
+        url: '/updater',
+        data: {room: content.dataset.room, since: cursor},
+        type: 'GET',
+        dataType: 'json',
+        headers: etag ? {'If-None-Match': etag} : {},
+
+        success: function(response, status, xhr){
+            if (xhr.status === 304 || !response){
+                repeater = setTimeout(doWork, 5000);
+                return;
+            }
+            etag = xhr.getResponseHeader('ETag');
+            if (response.deleted){
+                roomDeleted(response.deleted);
+                return;
+            }
+            addEntries(response.entries);
+            repeater = setTimeout(doWork, 5000);
         },
         error: function(error){
             console.log(error);
+            repeater = setTimeout(doWork, 5000);
         }
     });
-    repeater = setTimeout(doWork, 5000);
 }
 
-doWork();
+// Server pushed updates, the browser reconnects by itself and resumes from the last event id
+function listen() {
+    events = new EventSource('/events/' + encodeURIComponent(content.dataset.room) + '?since=' + cursor);
+
+    events.onmessage = function(event){
+        addEntries([JSON.parse(event.data)]);
+    };
+    events.addEventListener('deleted', function(event){
+        roomDeleted(JSON.parse(event.data));
+        events.close();
+    });
+    events.onerror = function(error){
+        console.log(error);
+        if (events.readyState === EventSource.CLOSED){
+            doWork();
+        }
+    };
+}
+
+if (window.EventSource){
+    listen();
+}
+else {
+    doWork();
+}
 
 function redirection(event){
     event.preventdefault();
@@ -0,0 +1,175 @@
+// Raw chunk uploader for the options page. The files dropped together are started as one batch with a single
+// JSON request holding their details, then their chunks are sent as plain application/octet-stream bodies with
+// PUT and the server writes each chunk straight to its offset. Dropzone is only used to pick files and show progress.
+// Files are hashed in a Web Worker first: the server checks the upload against the hash and a file it already
+// holds is linked on the server instead of being sent again.
+
+var CHUNK_SIZE = 10000000;
+var PARALLEL_FILES = 3;
+var PARALLEL_CHUNKS = 3;
+var CHUNK_RETRIES = 3;
+
+// A batch keeps its id in localStorage until all of its files have finished, so after an interruption
+// the batch is resumed and the chunks the server already has are skipped
+function batchKey(room, files) {
+    return ["batch", room].concat(files.map(function(file){
+        return [file.name, file.size, file.lastModified].join("/");
+    })).join(":");
+}
+
+// Resolves with the SHA-256 of a file computed by the hash worker, or null when it could not be hashed
+function hashFile(worker, file, id) {
+    return new Promise(function(resolve){
+        worker.addEventListener("message", function listener(event){
+            if (event.data.id !== id || event.data.progress !== undefined){
+                return;
+            }
+            worker.removeEventListener("message", listener);
+            resolve(event.data.sha256 || null);
+        });
+        worker.postMessage({id: id, file: file});
+    });
+}
+
+// Asks the server whether its blob store holds a file with this SHA-256
+function blobExists(sha256) {
+    return fetch('/blobs/' + sha256, {method: 'HEAD', credentials: 'same-origin'}).then(function(response){
+        return response.ok;
+    }).catch(function(){
+        return false;
+    });
+}
+
+async function hashFiles(files, workerUrl) {
+    if (!window.Worker){
+        return files.map(function(){ return null; });
+    }
+    var worker = new Worker(workerUrl);
+    var hashes = [];
+    for (let i = 0; i < files.length; i++){
+        hashes.push(await hashFile(worker, files[i], i));
+    }
+    worker.terminate();
+    return hashes;
+}
+
+function startBatch(details) {
+    return fetch('/batch', {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(details)
+    }).then(function(response){
+        if (!response.ok){
+            throw new Error("Upload could not be started");
+        }
+        return response.json();
+    });
+}
+
+function sendChunk(uploadId, file, index, attempt) {
+    var blob = file.slice(index * CHUNK_SIZE, Math.min(file.size, (index + 1) * CHUNK_SIZE));
+    return fetch('/upload/' + uploadId + '/' + index, {
+        method: 'PUT',
+        credentials: 'same-origin',
+        headers: {'Content-Type': 'application/octet-stream'},
+        body: blob
+    }).then(function(response){
+        if (!response.ok){
+            throw new Error("Chunk " + index + " of " + file.name + " failed");
+        }
+        return response.json();
+    }).catch(function(error){
+        if (attempt < CHUNK_RETRIES){
+            return sendChunk(uploadId, file, index, attempt + 1);
+        }
+        throw error;
+    });
+}
+
+// Sends the chunks of one file the server does not have yet, upload is the status of its slot in the batch
+async function uploadFile(dropzone, file, upload) {
+    file.status = Dropzone.UPLOADING;
+    dropzone.emit("processing", file);
+
+    var pending = [];
+    for (let i = 0; i < upload.total; i++){
+        if (upload.received.indexOf(i) === -1){
+            pending.push(i);
+        }
+    }
+    var done = upload.total - pending.length;
+
+    async function worker() {
+        while (pending.length){
+            let index = pending.shift();
+            await sendChunk(upload.upload_id, file, index, 0);
+            done++;
+            dropzone.emit("uploadprogress", file, 100 * done / upload.total, Math.min(file.size, done * CHUNK_SIZE));
+        }
+    }
+    let workers = [];
+    for (let i = 0; i < PARALLEL_CHUNKS; i++){
+        workers.push(worker());
+    }
+    await Promise.all(workers);
+
+    dropzone.emit("uploadprogress", file, 100, file.size);
+    file.status = Dropzone.SUCCESS;
+    dropzone.emit("success", file);
+    dropzone.emit("complete", file);
+}
+
+// Uploads the queued files of the dropzone as one batch, PARALLEL_FILES files at a time
+async function uploadQueue(dropzone, room, options) {
+    var files = dropzone.getQueuedFiles();
+    if (!files.length){
+        return;
+    }
+
+    var hashes = await hashFiles(files, options.hashWorker);
+    var stored = await Promise.all(hashes.map(function(sha256){
+        return sha256 ? blobExists(sha256) : false;
+    }));
+
+    var key = batchKey(room, files);
+    var batch = await startBatch({
+        batch_id: localStorage.getItem(key),
+        compress: options.compress,
+        zipname: options.zipname,
+        files: files.map(function(file, i){
+            return {filename: file.name, size: file.size, chunk_size: CHUNK_SIZE, note: options.note(file),
+                sha256: hashes[i], link: stored[i]};
+        })
+    });
+    localStorage.setItem(key, batch.batch_id);
+
+    // Files keep the order they were posted in, file i fills slot i of the batch
+    var queued = files.map(function(file, i){ return [file, batch.files[i]]; });
+    var failed = false;
+
+    async function worker() {
+        while (queued.length){
+            let [file, upload] = queued.shift();
+            try {
+                await uploadFile(dropzone, file, upload);
+            }
+            catch (error) {
+                console.log(error);
+                failed = true;
+                file.status = Dropzone.ERROR;
+                dropzone.emit("error", file, error.message);
+                dropzone.emit("complete", file);
+            }
+        }
+    }
+    let workers = [];
+    for (let i = 0; i < PARALLEL_FILES; i++){
+        workers.push(worker());
+    }
+    await Promise.all(workers);
+
+    if (!failed){
+        localStorage.removeItem(key);
+    }
+}